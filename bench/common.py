@@ -0,0 +1,168 @@
+# Helpers shared by the benchmarks in this directory.
+#
+# Each benchmark takes --browser PATH (repeatable) so a revision can be
+# compared with an older one:
+#
+#   git show <rev>:browser.py > /tmp/before.py
+#   python bench/parse.py --browser /tmp/before.py --browser browser.py
+#
+# Without --browser the working tree's browser.py is measured.
+
+import argparse
+import os
+import random
+import sys
+import time
+import types
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def load_browser(path):
+    # browser.py ends by creating a Tk image from openmoji/, which needs a
+    # display and files that aren't in the repo. Nothing measured here is
+    # defined after the __main__ block, so only the code above it is run.
+    with open(path, encoding="utf8") as f:
+        source = f.read()
+    source = source.split('\nif __name__ == "__main__":', 1)[0]
+    name = os.path.splitext(os.path.basename(path))[0]
+    module = types.ModuleType(name)
+    module.__file__ = os.path.abspath(path)
+    # browser.css is opened relative to the working directory.
+    cwd = os.getcwd()
+    os.chdir(ROOT)
+    try:
+        exec(compile(source, path, "exec"), module.__dict__)
+    finally:
+        os.chdir(cwd)
+    return module
+
+def arguments(description, **extra):
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument("--browser", action="append", default=[],
+                        help="browser.py to measure; repeat to compare")
+    for flag, options in extra.items():
+        parser.add_argument("--" + flag.replace("_", "-"), **options)
+    args = parser.parse_args()
+    if not args.browser:
+        args.browser = [os.path.join(ROOT, "browser.py")]
+    # Tree walks in some revisions recurse once per level of the page.
+    sys.setrecursionlimit(100000)
+    return args
+
+def best_of(repeat, fn, *args):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(*args)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def read_pages(paths):
+    return "".join(open(path, encoding="utf8").read() for path in paths)
+
+WORDS = ("the of and to in is that for it as with was on be by this are "
+         "or from at which an have not but all can more one has were "
+         "function value returns type struct trait module crate option "
+         "result error iterator string slice vector borrow lifetime").split()
+
+TAGS = ["div", "span", "a", "p", "pre", "code", "li", "ul", "h2", "h3",
+        "section", "nav", "table", "td", "em", "b", "i", "button", "form"]
+
+CLASSES = ["docblock", "item-name", "module-item", "stab", "fn", "struct",
+           "trait", "since", "out-of-band", "srclink", "in-band", "method",
+           "impl"] + ["c%d" % i for i in range(400)]
+
+def sentence(rnd, low=6, high=30):
+    return " ".join(rnd.choice(WORDS) for _ in range(rnd.randint(low, high)))
+
+def inline(rnd):
+    # A paragraph's worth of text with a few links and inline elements.
+    parts = []
+    for _ in range(rnd.randint(2, 6)):
+        parts.append(sentence(rnd, 3, 15))
+        k = rnd.random()
+        if k < .3:
+            parts.append('<a href="/doc/%s.html" class="%s">%s</a>' % (
+                rnd.choice(WORDS), rnd.choice(CLASSES), rnd.choice(WORDS)))
+        elif k < .5:
+            parts.append("<code>%s</code>" % rnd.choice(WORDS))
+        elif k < .6:
+            parts.append("<em>%s</em>" % sentence(rnd, 1, 3))
+    return " ".join(parts)
+
+def section(rnd, depth):
+    out = ['<section class="%s" id="s%d">' % (
+        rnd.choice(CLASSES), rnd.randrange(10 ** 6))]
+    out.append("<h%d>%s</h%d>" % (depth + 2, sentence(rnd, 2, 6), depth + 2))
+    for _ in range(rnd.randint(2, 6)):
+        k = rnd.random()
+        if k < .45:
+            out.append('<p class="%s">%s</p>' % (
+                rnd.choice(CLASSES), inline(rnd)))
+        elif k < .6:
+            out.append('<pre class="code"><code>%s\n%s</code></pre>' % (
+                sentence(rnd), sentence(rnd)))
+        elif k < .75:
+            out.append('<ul class="%s">%s</ul>' % (rnd.choice(CLASSES), "".join(
+                "<li>%s</li>" % inline(rnd) for _ in range(rnd.randint(2, 8)))))
+        elif k < .85:
+            out.append("<table>%s</table>" % "".join(
+                "<tr><td>%s</td><td>%s</td></tr>" % (
+                    rnd.choice(WORDS), sentence(rnd, 2, 8))
+                for _ in range(rnd.randint(2, 6))))
+        elif depth < 4:
+            out.append(section(rnd, depth + 1))
+    out.append("</section>")
+    return "\n".join(out)
+
+def document_page(size, seed=1):
+    # A tag-dense page shaped like generated documentation: nested sections,
+    # lists, tables and short runs of text between inline elements.
+    rnd = random.Random(seed)
+    out = ['<!doctype html><html lang="en"><head><meta charset="utf-8">'
+           "<title>Documentation</title></head><body>",
+           '<nav class="sidebar"><ul>%s</ul></nav>' % "".join(
+               '<li><a href="/doc/%d.html">%s</a></li>' % (
+                   i, rnd.choice(WORDS)) for i in range(100)),
+           '<main class="content">']
+    length = sum(len(part) for part in out)
+    while length < size:
+        part = section(rnd, 0)
+        out.append(part)
+        length += len(part)
+    out.append("</main></body></html>")
+    return "\n".join(out)
+
+def text_page(size, seed=1):
+    # Long paragraphs of plain text with almost no markup.
+    rnd = random.Random(seed)
+    out = ["<!doctype html><html><head><title>Text</title></head><body>"]
+    length = len(out[0])
+    while length < size:
+        part = "<p>%s</p>\n" % " ".join(
+            sentence(rnd, 20, 40) + "." for _ in range(10))
+        out.append(part)
+        length += len(part)
+    out.append("</body></html>")
+    return "".join(out)
+
+def stylesheet(count, seed=2):
+    # count rules mixing tag, class and descendant selectors, the shapes
+    # real site stylesheets are mostly made of.
+    rnd = random.Random(seed)
+    rules = []
+    for i in range(count):
+        k = rnd.random()
+        if k < .2:
+            selector = rnd.choice(TAGS)
+        elif k < .6:
+            selector = "." + rnd.choice(CLASSES)
+        elif k < .9:
+            selector = rnd.choice(TAGS) + " ." + rnd.choice(CLASSES)
+        else:
+            selector = "." + rnd.choice(CLASSES) + " " + rnd.choice(TAGS)
+        rules.append("%s { color: #%06x }" % (
+            selector, rnd.randrange(1 << 24)))
+    return "\n".join(rules)
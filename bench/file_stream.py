@@ -0,0 +1,91 @@
+# Streaming a large local page into the parser.
+#
+#   python bench/file_stream.py [--browser PATH ...] [--size MB]
+#
+# Writes a mostly-text generated report of the given size to a temporary
+# file and parses it through a file:// URL the way a tab does, one chunk
+# at a time. Each browser.py is run in its own process so that peak memory
+# can be compared; reports the total time, the time until the first 5000
+# characters of text reached the parser, and peak RSS (total and
+# anonymous, i.e. excluding file-backed pages the OS can drop).
+
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from common import arguments, load_browser
+
+def write_report(path, size, seed=3):
+    rnd = random.Random(seed)
+    with open(path, "w", encoding="utf8") as f:
+        f.write("<!doctype html><html><head><meta charset=utf-8>"
+                "<title>Report</title></head><body><h1>Build report</h1>")
+        written = 0
+        i = 0
+        while written < size:
+            line = "<pre class=log id=l%d>%s</pre>\n" % (i, " ".join(
+                "tok%06d" % rnd.randrange(10 ** 6)
+                for _ in range(rnd.randint(20, 60))))
+            f.write(line)
+            written += len(line)
+            i += 1
+        f.write("<p>é \U0001F600 end</p></body></html>")
+
+def memory():
+    # Current RSS and anonymous RSS in kB, from /proc where there is one.
+    rss = anon = 0
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS"):
+                    rss = int(line.split()[1])
+                elif line.startswith("RssAnon"):
+                    anon = int(line.split()[1])
+    except OSError:
+        pass
+    return rss, anon
+
+def run(browser_path, page_path):
+    peak = [0, 0]
+    def sample():
+        while True:
+            rss, anon = memory()
+            peak[0] = max(peak[0], rss)
+            peak[1] = max(peak[1], anon)
+            time.sleep(0.05)
+    browser = load_browser(browser_path)
+    threading.Thread(target=sample, daemon=True).start()
+    start = time.perf_counter()
+    parser = browser.HTMLParser()
+    first = None
+    for chunk in browser.URL("file://" + page_path).stream(None):
+        parser.feed(chunk)
+        if first is None and parser.text_length > 5000:
+            first = time.perf_counter() - start
+    tree = parser.close()
+    elapsed = time.perf_counter() - start
+    time.sleep(0.1)
+    nodes = len(browser.tree_to_list(tree, []))
+    print("%-24s %7d nodes %6.2fs first text %6.3fs "
+          "peak RSS %5dMB (%5dMB anonymous)" % (
+              browser_path[-24:], nodes, elapsed, first or elapsed,
+              peak[0] // 1024, peak[1] // 1024), flush=True)
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["--child"]:
+        run(sys.argv[2], sys.argv[3])
+        sys.exit(0)
+    args = arguments("Time streaming a large file:// page.",
+                     size=dict(type=int, default=200,
+                               help="size of the generated page in MB"))
+    with tempfile.TemporaryDirectory() as directory:
+        page_path = os.path.join(directory, "report.html")
+        write_report(page_path, args.size * 1024 * 1024)
+        for path in args.browser:
+            subprocess.run([sys.executable, os.path.abspath(__file__),
+                            "--child", os.path.abspath(path), page_path],
+                           check=True)
@@ -0,0 +1,35 @@
+# Memory held by a parsed DOM.
+#
+#   python bench/memory.py [--browser PATH ...] [--page FILE ...]
+#
+# Parses a generated 2MB documentation-like page, or the given pages joined
+# together, and reports the bytes still allocated once the tree is built,
+# in total and per node.
+
+import gc
+import tracemalloc
+
+from common import arguments, document_page, load_browser, read_pages
+
+def measure(browser, body):
+    gc.collect()
+    tracemalloc.start()
+    tree = browser.HTMLParser(body).parse()
+    gc.collect()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return size, len(browser.tree_to_list(tree, []))
+
+if __name__ == "__main__":
+    args = arguments("Measure the memory a parsed DOM holds.",
+                     page=dict(action="append", default=[]),
+                     size=dict(type=int, default=2_000_000))
+    if args.page:
+        body = read_pages(args.page)
+    else:
+        body = document_page(args.size)
+    for path in args.browser:
+        browser = load_browser(path)
+        size, nodes = measure(browser, body)
+        print("%-24s %7d nodes %6.1fMB %5dB/node" % (
+            path[-24:], nodes, size / 1e6, size / nodes), flush=True)
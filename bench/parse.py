@@ -0,0 +1,40 @@
+# Tokenizer and parser speed.
+#
+#   python bench/parse.py [--browser PATH ...] [--page FILE ...]
+#
+# Parses a generated 5MB documentation-like page and a 5MB page of plain
+# text, or the given pages joined together, and reports the best of a few
+# runs: once with the tree builder stubbed out, to time the tokenizer
+# alone, and once as a full parse.
+
+from common import arguments, best_of, document_page, load_browser, \
+    read_pages, text_page
+
+def tokenize_only(browser, body):
+    class Tokenizer(browser.HTMLParser):
+        def add_tag(self, tag): pass
+        def add_text(self, text): pass
+        def finish(self): pass
+    Tokenizer(body).parse()
+
+def parse(browser, body):
+    browser.HTMLParser(body).parse()
+
+if __name__ == "__main__":
+    args = arguments("Time HTML tokenizing and parsing.",
+                     page=dict(action="append", default=[]),
+                     size=dict(type=int, default=5_000_000),
+                     repeat=dict(type=int, default=3))
+    if args.page:
+        pages = [("pages", read_pages(args.page))]
+    else:
+        pages = [("document", document_page(args.size)),
+                 ("text", text_page(args.size))]
+    for path in args.browser:
+        browser = load_browser(path)
+        for name, body in pages:
+            for label, fn in (("tokenize", tokenize_only), ("parse", parse)):
+                seconds = best_of(args.repeat, fn, browser, body)
+                print("%-24s %-8s %-8s %5.1fMB %6.2fs" % (
+                    path[-24:], name, label, len(body) / 1e6, seconds),
+                    flush=True)
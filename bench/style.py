@@ -0,0 +1,58 @@
+# Style matching against large stylesheets.
+#
+#   python bench/style.py [--browser PATH ...] [--page FILE ...]
+#                         [--rules N ...]
+#
+# Parses a generated 1.3MB documentation-like page, or the given pages
+# joined together, and times styling the whole document with the default
+# style sheet plus N generated rules. Where the browser.py supports DOM
+# mutation it also times restyling one 200-400 node subtree after an
+# attribute change, which is what a page update costs.
+
+from common import arguments, best_of, document_page, load_browser, \
+    read_pages, stylesheet
+
+def sorted_rules(browser, count):
+    rules = browser.DEFAULT_STYLE_SHEET.copy()
+    if count:
+        rules += browser.CSSParser(stylesheet(count)).parse()
+    return sorted(rules, key=browser.cascade_priority)
+
+def subtree(browser, tree):
+    # A mid-sized subtree from the middle of the document.
+    found = [node for node in browser.tree_to_list(tree, [])
+             if isinstance(node, browser.Element)
+             and 200 < len(browser.tree_to_list(node, [])) < 400]
+    return found[len(found) // 2]
+
+def restyle(browser, tree, node, rules):
+    node.set_attribute("data-bench", "")
+    browser.restyle(tree, rules)
+
+if __name__ == "__main__":
+    args = arguments("Time styling a page against large stylesheets.",
+                     page=dict(action="append", default=[]),
+                     size=dict(type=int, default=1_300_000),
+                     rules=dict(type=int, action="append", default=[]),
+                     repeat=dict(type=int, default=3))
+    if args.page:
+        body = read_pages(args.page)
+    else:
+        body = document_page(args.size)
+    for path in args.browser:
+        browser = load_browser(path)
+        for count in args.rules or [0, 300, 3000]:
+            rules = sorted_rules(browser, count)
+            tree = browser.HTMLParser(body).parse()
+            seconds = best_of(args.repeat, browser.style, tree, rules)
+            line = "%-24s %5d rules  style %8.1fms" % (
+                path[-24:], len(rules), seconds * 1000)
+            if hasattr(browser, "restyle"):
+                # Later revisions keep the compiled rules on the document.
+                rules = getattr(tree, "rules", rules)
+                node = subtree(browser, tree)
+                seconds = best_of(args.repeat, restyle, browser, tree, node,
+                                  rules)
+                line += "  restyle %d nodes %7.2fms" % (
+                    len(browser.tree_to_list(node, [])), seconds * 1000)
+            print(line, flush=True)
@@ -1,8 +1,25 @@
 #!/usr/bin/env python3
 import socket
+import sys
 import ssl
 import os.path
-from datetime import datetime
+import select
+import mmap
+import threading
+import time
+import zlib
+import codecs
+import itertools
+import re
+import hashlib
+import html
+import json
+import queue
+import traceback
+import types
+import weakref
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 import tkinter
 import tkinter.font
 
@@ -29,7 +46,7 @@ def set_parameters(**params):
 
 
 class Browser:
-    def __init__(self):
+    def __init__(self, speculate=False):
         self.window = tkinter.Tk()
         self.canvas = tkinter.Canvas(
             self.window, 
@@ -45,6 +62,9 @@ class Browser:
         self.tabs = []
         self.active_tab = None
         self.chrome = Chrome(self)
+        self.loader = PageLoader(self)
+        # Speculative prefetching of likely next pages is opt-in.
+        self.speculator = Speculator(self) if speculate else None
         self.window.bind("<Down>", self.handle_down)
         self.window.bind("<Up>", self.handle_up)
         self.window.bind("<Configure>", self.resize)
@@ -54,6 +74,7 @@ class Browser:
         self.window.bind("<Key>", self.handle_key)
         self.window.bind("<Return>", self.handle_enter)
         self.window.bind("<BackSpace>", self.handle_backspace)
+        self.window.bind("<Motion>", self.handle_motion)
 
     def new_tab(self, url):
         new_tab = Tab(HEIGHT - self.chrome.bottom, self)
@@ -127,6 +148,149 @@ class Browser:
         self.chrome.backspace()
         self.draw()
 
+    def handle_motion(self, e):
+        if not self.speculator or e.y < self.chrome.bottom: return
+        url = self.active_tab.link_at(e.x, e.y - self.chrome.bottom)
+        if url: self.speculator.speculate(url)
+
+class PageLoader:
+    # How often, in ms, the Tk loop checks for finished loads.
+    POLL_INTERVAL = 16
+
+    def __init__(self, browser):
+        self.browser = browser
+        self.results = queue.Queue()
+        self.browser.window.after(self.POLL_INTERVAL, self.poll)
+
+    def start(self, tab, url):
+        load_id = tab.load_id
+        cancelled = lambda: tab.load_id != load_id
+        thread = threading.Thread(
+            target=self.run, args=(tab, url, load_id, cancelled), daemon=True)
+        thread.start()
+
+    def run(self, tab, url, load_id, cancelled):
+        def progress(nodes):
+            # The worker waits while the Tk thread lays out the partial
+            # tree, so the parser never mutates a tree that's being laid out.
+            done = threading.Event()
+            self.results.put((tab, url, load_id, nodes, done))
+            done.wait()
+
+        try:
+            result = tab.prepare(url, cancelled, progress)
+        except Exception as e:
+            result = e
+        if result is not None and not cancelled():
+            self.results.put((tab, url, load_id, result, None))
+
+    def poll(self):
+        # Tk isn't thread safe, so finished loads are handed back here
+        # and only ever touch the canvas from the Tk thread.
+        redraw = False
+        while True:
+            try:
+                tab, url, load_id, result, done = self.results.get_nowait()
+            except queue.Empty:
+                break
+            # A page that fails to lay out mustn't stop polling or leave
+            # its worker waiting on done.
+            try:
+                if tab.load_id != load_id:
+                    pass
+                elif isinstance(result, Exception):
+                    tab.loading = False
+                    traceback.print_exception(result)
+                    redraw = True
+                elif done is not None:
+                    tab.render(result)
+                    redraw = True
+                else:
+                    tab.finish_load(url, result)
+                    redraw = True
+            except Exception:
+                tab.loading = False
+                traceback.print_exc()
+                redraw = True
+            finally:
+                if done is not None: done.set()
+        try:
+            if redraw:
+                self.browser.draw()
+        finally:
+            self.browser.window.after(self.POLL_INTERVAL, self.poll)
+
+class Speculator:
+    def __init__(self, browser, budget=4, preparse=True, max_age=60):
+        self.browser = browser
+        # At most this many speculative loads are kept (or in flight) at once.
+        self.budget = budget
+        # Also parse and style speculative pages, not just fetch them.
+        self.preparse = preparse
+        self.max_age = max_age
+        # url key -> (start time, future), oldest first
+        self.entries = OrderedDict()
+        self.executor = ThreadPoolExecutor(max_workers=2)
+        self.lock = threading.Lock()
+        self.used = 0
+        self.wasted = 0
+
+    def __repr__(self):
+        return "Speculator(entries={}, used={}, wasted={})".format(
+            len(self.entries), self.used, self.wasted)
+
+    def key(self, url):
+        return f"{url.scheme}://{url.host}:{url.port}{url.path}"
+
+    def speculate(self, url):
+        if url.scheme not in ["http", "https", "file"]: return
+        key = self.key(url)
+        with self.lock:
+            if key in self.entries: return
+            self.entries[key] = (time.monotonic(),
+                                 self.executor.submit(self.run, url))
+            while len(self.entries) > self.budget:
+                _, (_, future) = self.entries.popitem(last=False)
+                future.cancel()
+                self.wasted += 1
+
+    def speculate_visible(self, tab):
+        # Links already on screen are the most likely next navigations.
+        current = self.key(tab.url)
+        for href in itertools.islice(tab.visible_links(), self.budget):
+            try:
+                url = tab.url.resolve(href)
+            except Exception:
+                continue
+            if self.key(url) != current:
+                self.speculate(url)
+
+    def run(self, url):
+        if not self.preparse:
+            return url.request(self.browser)
+        return Tab(HEIGHT, self.browser).fetch(url, lambda: False)
+
+    def take(self, url):
+        # Returns the prefetched body or styled tree for url, if any.
+        with self.lock:
+            entry = self.entries.pop(self.key(url), None)
+            if entry is None: return None
+            start, future = entry
+            if time.monotonic() - start > self.max_age:
+                future.cancel()
+                self.wasted += 1
+                return None
+        # Waiting for a load still in flight mustn't hold the lock.
+        try:
+            result = future.result()
+        except Exception:
+            with self.lock:
+                self.wasted += 1
+            return None
+        with self.lock:
+            self.used += 1
+        return result
+
 class Rect:
     def __init__(self, left, top, right, bottom):
         self.left = left
@@ -191,8 +355,15 @@ class Chrome:
             self.padding + back_width,
             self.urlbar_bottom - self.padding)
         
+        forward_width = self.font.measure(">") + 2*self.padding
+        self.forward_rect = Rect(
+            self.back_rect.right + self.padding,
+            self.urlbar_top + self.padding,
+            self.back_rect.right + self.padding + forward_width,
+            self.urlbar_bottom - self.padding)
+        
         self.address_rect = Rect(
-            self.back_rect.top + self.padding,
+            self.forward_rect.right + self.padding,
             self.urlbar_top + self.padding,
             WIDTH - self.padding * 2 - 20,
             self.urlbar_bottom - self.padding,
@@ -217,6 +388,8 @@ class Chrome:
             self.address_bar = ""
         elif self.back_rect.containsPoint(x, y):
             self.browser.active_tab.go_back()
+        elif self.forward_rect.containsPoint(x, y):
+            self.browser.active_tab.go_forward()
         elif self.bookmarks_rect.containsPoint(x, y):
             if str(self.browser.active_tab.url) in self.browser.bookmarks:
                 self.browser.bookmarks.remove(str(self.browser.active_tab.url))
@@ -256,6 +429,11 @@ class Chrome:
         cmds.append(DrawLine(
             0, self.bottom, WIDTH,
             self.bottom, "black", 1))
+        # Loading indicator: a thick blue bar along the bottom of the chrome.
+        if self.browser.active_tab and self.browser.active_tab.loading:
+            cmds.append(DrawLine(
+                0, self.bottom, WIDTH,
+                self.bottom, "blue", 3))
         cmds.append(DrawOutline(self.newtab_rect, "black", 1))
         cmds.append(DrawText(
             self.newtab_rect.left + self.padding,
@@ -311,6 +489,11 @@ class Chrome:
             self.back_rect.left + self.padding,
             self.back_rect.top,
             "<", self.font, "black"))
+        cmds.append(DrawOutline(self.forward_rect, "black", 1))
+        cmds.append(DrawText(
+            self.forward_rect.left + self.padding,
+            self.forward_rect.top,
+            ">", self.font, "black"))
         cmds.append(DrawOutline(self.address_rect, "black", 1))
         url = str(self.browser.active_tab.url) 
         cmds.append(DrawText(
@@ -326,58 +509,164 @@ class Tab:
         self.tab_height = tab_height
         self.history = []
         self.browser = browser
+        self.url = None
+        self.nodes = None
+        self.document = None
+        self.display_list = []
+        self.loading = False
+        # Bumped on every navigation so older, superseded loads get dropped.
+        self.load_id = 0
+        # Pages we went back from, most recent last.
+        self.forward = []
+        self.bfcache = BackForwardCache()
 
     
     def __repr__(self):
         return "Tab(history={})".format(self.history)
 
     def load(self, url):
+        # A new navigation drops the forward history.
+        self.leave()
+        for forward_url in self.forward:
+            self.bfcache.discard(forward_url)
+        self.forward = []
+        self.start_load(url)
+
+    def navigate(self, url):
+        # Moves through history, restoring the page from the cache if we can.
+        entry = self.bfcache.take(url)
+        if entry is None:
+            self.start_load(url)
+            return
         self.history.append(url)
         self.url = url
-        body = url.request(self.browser)
-        self.nodes = HTMLParser(body).parse()
-        
+        self.load_id += 1
+        self.loading = False
+        self.nodes = entry.nodes
+        self.document = entry.document
+        self.display_list = entry.display_list
+        self.scroll = entry.scroll
+
+    def leave(self):
+        # Keep the page we're leaving around in case we come back to it.
+        if self.document and not self.loading:
+            self.bfcache.store(self.url, BackForwardEntry(
+                self.nodes, self.document, self.display_list, self.scroll))
+
+    def start_load(self, url):
+        self.history.append(url)
+        self.url = url
+        self.scroll = 0
+        self.loading = True
+        self.load_id += 1
+        if self.browser is None:
+            # No event loop to hand results back to, so load in place.
+            self.finish_load(url, self.prepare(url, lambda: False))
+        else:
+            self.browser.loader.start(self, url)
+
+    def prepare(self, url, cancelled, progress=None):
+        # Picks up a speculative load of this URL if one was made.
+        speculator = self.browser.speculator if self.browser else None
+        prepared = speculator.take(url) if speculator else None
+        if isinstance(prepared, Element): return prepared
+        return self.fetch(url, cancelled, progress, prepared)
+
+    def fetch(self, url, cancelled, progress=None, body=None):
+        # Network, parsing and styling only touch the DOM, so this runs
+        # off the Tk thread. Returns None if a newer load superseded it.
+        # Bytes are parsed as they arrive; whenever enough new text has been
+        # parsed, the partial tree is styled and handed to progress().
+        parser = HTMLParser()
         rules = DEFAULT_STYLE_SHEET.copy()
-        style(self.nodes, sorted(rules, key=cascade_priority))
-
-        links = [node.attributes["href"]
-             for node in tree_to_list(self.nodes, [])
-             if isinstance(node, Element)
-             and node.tag == "link"
-             and node.attributes.get("rel") == "stylesheet"
+        links = []
+        next_paint = self.first_paint_length()
+        chunks = url.stream(self.browser) if body is None else [body]
+        for chunk in chunks:
+            if cancelled(): return None
+            parser.feed(chunk)
+            if progress and parser.text_length >= next_paint:
+                nodes = parser.partial_tree()
+                self.load_stylesheets(url, nodes, links, rules)
+                style(nodes, sorted(rules, key=cascade_priority))
+                if cancelled(): return None
+                progress(nodes)
+                # Doubling keeps the total relayout work linear in page size.
+                next_paint = 2 * parser.text_length
+        nodes = parser.close()
+
+        self.load_stylesheets(url, nodes, links, rules)
+        if cancelled(): return None
+        style(nodes, sorted(rules, key=cascade_priority))
+        return nodes
+
+    def first_paint_length(self):
+        # Roughly how many characters of text it takes to fill the viewport.
+        return (WIDTH // HSTEP) * (self.tab_height // VSTEP)
+
+    def load_stylesheets(self, url, nodes, links, rules):
+        # links holds the stylesheets already loaded; only new ones are fetched.
+        found = [node.attributes["href"]
+             for node in nodes.index.tags.get("link", ())
+             if node.attributes.get("rel") == "stylesheet"
              and "href" in node.attributes]
+        new_links = found[len(links):]
+        links.extend(new_links)
         
-        for link in links:
-            try:
-                body = url.resolve(link).request(self.browser)
-            except:
-                continue
+        # Fetched concurrently, but merged in document order so the
+        # cascade doesn't depend on which stylesheet arrived first.
+        for body in URL.fetcher.fetch_all(url, new_links, self.browser):
+            if body is None: continue
             rules.extend(CSSParser(body).parse())
 
-        self.document = DocumentLayout(self.nodes)
-        self.document.layout()
+    def finish_load(self, url, nodes):
+        self.render(nodes)
 
         #E7.3
         if url.fragment != None:
             # print("FRAG:", url.fragment)
             self.scroll_to(url.fragment)
+        self.loading = False
+        if self.browser and self.browser.speculator:
+            self.browser.speculator.speculate_visible(self)
 
+    def render(self, nodes):
+        # Layout measures text with Tk fonts, so it has to stay on the Tk thread.
+        self.nodes = nodes
+        self.document = DocumentLayout(self.nodes)
+        self.document.layout()
 
         self.display_list = []
 
         paint_tree(self.document, self.display_list)
     
+    def update(self):
+        # Brings style, layout and paint up to date after the DOM has been
+        # changed through the mutation methods, redoing only what changed.
+        if not self.document or self.nodes.rules is None: return
+        restyle(self.nodes, self.nodes.rules)
+        self.document.relayout()
+        self.display_list = []
+        paint_tree(self.document, self.display_list)
+
     def scroll_to(self, fragment):
-        for obj in tree_to_list(self.document, []):
-            if isinstance(obj.node, Element):
-                if (obj.node.attributes.get("id")==fragment):
-                    self.scroll  =obj.y
+        elt = self.nodes.index.ids.get(fragment)
+        # Inline elements have no block of their own; use the one they're in.
+        while elt and elt not in self.document.blocks:
+            elt = elt.parent
+        if elt: self.scroll = self.document.blocks[elt].y
 
     def go_back(self):
         if len(self.history) > 1:
-            self.history.pop()
+            self.leave()
+            self.forward.append(self.history.pop())
             back = self.history.pop()
-            self.load(back)
+            self.navigate(back)
+
+    def go_forward(self):
+        if self.forward:
+            self.leave()
+            self.navigate(self.forward.pop())
 
     def draw(self, canvas, offset):
         for cmd in self.display_list:
@@ -388,6 +677,7 @@ class Tab:
 
     # The +/-40 in the following methods is something I added to be able to see the top/bottom of the page, kinda arbitrary
     def scrolldown(self):
+        if not self.document: return
         max_y = max(
             self.document.height + 2*VSTEP - self.tab_height, 0)
         self.scroll = min(self.scroll + SCROLL_STEP, max_y)
@@ -398,6 +688,7 @@ class Tab:
         # self.draw()
 
     def mousewheel(self, delta):
+        if not self.document: return
         newScroll = self.scroll - delta
         max_y = max(self.document.height + 2*VSTEP - HEIGHT, 0)
         if (newScroll < 0 - 40): return
@@ -409,14 +700,30 @@ class Tab:
 
     
 
+    def layout_at(self, x, y):
+        # The deepest object under the point. This runs on every mouse move,
+        # so it only goes down into boxes that contain the point, taking
+        # the last such child, as that one would come last in pre-order.
+        found = None
+        candidates = [self.document]
+        while candidates:
+            for obj in reversed(candidates):
+                if obj.x <= x < obj.x + obj.width \
+                    and obj.y <= y < obj.y + obj.height:
+                    found = obj
+                    candidates = obj.children
+                    break
+            else:
+                break
+        return found
+
     def click(self, newX, newY):
+        if not self.document: return
         x, y = newX, newY
         y += self.scroll
-        objs = [obj for obj in tree_to_list(self.document, [])
-            if obj.x <= x < obj.x + obj.width
-            and obj.y <= y < obj.y + obj.height]
-        if not objs: return
-        elt = objs[-1].node
+        obj = self.layout_at(x, y)
+        if not obj: return
+        elt = obj.node
         while elt:
             if isinstance(elt, Text):
                 pass
@@ -430,14 +737,38 @@ class Tab:
                     return self.load(url)
             elt = elt.parent
 
+    def link_at(self, newX, newY):
+        if not self.document: return None
+        x, y = newX, newY + self.scroll
+        obj = self.layout_at(x, y)
+        if not obj: return None
+        elt = obj.node
+        while elt:
+            if isinstance(elt, Element) and elt.tag == "a" \
+                and elt.attributes.get("href", "#")[:1] not in ("", "#"):
+                return self.url.resolve(elt.attributes["href"])
+            elt = elt.parent
+        return None
+
+    def visible_links(self):
+        top, bottom = self.scroll, self.scroll + self.tab_height
+        for obj in tree_walk(self.document):
+            if not isinstance(obj, TextLayout): continue
+            if obj.y + obj.height < top or obj.y > bottom: continue
+            elt = obj.node
+            while elt:
+                if isinstance(elt, Element) and elt.tag == "a": break
+                elt = elt.parent
+            if elt and elt.attributes.get("href", "#")[:1] not in ("", "#"):
+                yield elt.attributes["href"]
+
     def middle_click(self, newX, newY, browser):
+        if not self.document: return
         x, y = newX, newY
         y += self.scroll
-        objs = [obj for obj in tree_to_list(self.document, [])
-            if obj.x <= x < obj.x + obj.width
-            and obj.y <= y < obj.y + obj.height]
-        if not objs: return
-        elt = objs[-1].node
+        obj = self.layout_at(x, y)
+        if not obj: return
+        elt = obj.node
         while elt:
             if isinstance(elt, Text):
                 pass
@@ -449,21 +780,178 @@ class Tab:
             elt = elt.parent
 
 
+class BackForwardEntry:
+    # Rough cost of one DOM node, layout object or draw command, in bytes.
+    OBJECT_SIZE = 400
+
+    def __init__(self, nodes, document, display_list, scroll):
+        self.nodes = nodes
+        self.document = document
+        self.display_list = display_list
+        self.scroll = scroll
+        self.size = self.OBJECT_SIZE * (
+            sum(1 for node in tree_walk(nodes)) +
+            sum(1 for obj in tree_walk(document)) + len(display_list))
+
+    def __repr__(self):
+        return "BackForwardEntry(size={}, scroll={})".format(
+            self.size, self.scroll)
+
+class BackForwardCache:
+    def __init__(self, budget=32 * 1024 * 1024):
+        self.budget = budget
+        # History URL -> BackForwardEntry, least recently used first. Keys
+        # are the URL objects in the history, so repeat visits stay distinct.
+        self.entries = OrderedDict()
+        self.size = 0
+
+    def __repr__(self):
+        return "BackForwardCache(entries={}, size={})".format(
+            len(self.entries), self.size)
+
+    def store(self, url, entry):
+        self.discard(url)
+        if entry.size > self.budget: return
+        self.entries[url] = entry
+        self.size += entry.size
+        while self.size > self.budget:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= evicted.size
+
+    def take(self, url):
+        entry = self.entries.pop(url, None)
+        if entry is not None:
+            self.size -= entry.size
+        return entry
+
+    def discard(self, url):
+        self.take(url)
+
+# Shared by every node without children or attributes, so leaves don't
+# each carry their own empty list and dict.
+EMPTY_CHILDREN = ()
+EMPTY_ATTRIBUTES = types.MappingProxyType({})
+EMPTY_CLASSES = frozenset()
+
+# Dirty bits, set by the mutation methods and cleared by restyle and relayout.
+STYLE_DIRTY = 1       # the node and everything under it need restyling
+LAYOUT_DIRTY = 2      # the block holding the node needs laying out again
+CHILDREN_DIRTY = 4    # the node's children changed; its other blocks can stay
+DESCENDANT_DIRTY = 8  # something under the node is dirty
+
+def mark_dirty(node, flags):
+    node.dirty |= flags
+    node = node.parent
+    # Ancestors above one that's already marked are marked too.
+    while node is not None and not node.dirty & DESCENDANT_DIRTY:
+        node.dirty |= DESCENDANT_DIRTY
+        node = node.parent
+
+def document_index(node):
+    while node.parent is not None:
+        node = node.parent
+    return getattr(node, "index", None)
+
 class Text:
+    __slots__ = ("text", "parent", "style", "dirty")
+    children = EMPTY_CHILDREN
+
     def __init__(self, text, parent):
         self.text = text
-        self.children = []
         self.parent = parent
+        self.dirty = 0
 
     def __repr__(self):
         return repr(self.text)
 
+    def set_text(self, text):
+        self.text = text
+        mark_dirty(self, LAYOUT_DIRTY)
+
 class Element:
+    __slots__ = ("tag", "raw_attributes", "parsed_attributes", "class_names",
+                 "children", "parent", "style", "dirty")
+
     def __init__(self, tag, attributes, parent):
         self.tag = tag
-        self.attributes = attributes
-        self.children = []
+        # attributes can also be the raw text after the tag name, which is
+        # then only parsed if something actually looks at the attributes.
+        if isinstance(attributes, str):
+            self.raw_attributes = attributes
+            self.parsed_attributes = None
+        else:
+            self.raw_attributes = None
+            self.parsed_attributes = attributes
+        self.class_names = None
+        self.children = EMPTY_CHILDREN
         self.parent = parent
+        self.dirty = 0
+
+    def add_child(self, node):
+        # Children start out as the shared empty tuple; most elements get
+        # a real list with their first child.
+        if self.children:
+            self.children.append(node)
+        else:
+            self.children = [node]
+
+    @property
+    def attributes(self):
+        if self.parsed_attributes is None:
+            self.parsed_attributes = parse_attributes(self.raw_attributes)
+            self.raw_attributes = None
+        return self.parsed_attributes
+
+    @attributes.setter
+    def attributes(self, attributes):
+        self.raw_attributes = None
+        self.parsed_attributes = attributes
+        self.class_names = None
+
+    # The class attribute, split once for the selectors that test it.
+    @property
+    def classes(self):
+        if self.class_names is None:
+            if "class" in self.attributes:
+                self.class_names = frozenset(self.attributes["class"].split())
+            else:
+                self.class_names = EMPTY_CLASSES
+        return self.class_names
+
+    # Changing the tree through these keeps the document's index up to date
+    # and marks what Tab.update has to redo.
+    def append_child(self, node):
+        if node.parent is not None:
+            node.parent.remove_child(node)
+        node.parent = self
+        self.add_child(node)
+        index = document_index(self)
+        if index:
+            for child in tree_walk(node):
+                if isinstance(child, Element): index.add(child)
+        mark_dirty(node, STYLE_DIRTY)
+        mark_dirty(self, CHILDREN_DIRTY)
+
+    def remove_child(self, node):
+        self.children.remove(node)
+        index = document_index(self)
+        if index:
+            for child in tree_walk(node):
+                if isinstance(child, Element): index.remove(child)
+        node.parent = None
+        mark_dirty(self, CHILDREN_DIRTY)
+
+    def set_attribute(self, name, value):
+        name = sys.intern(name.casefold())
+        # Attribute dicts can be shared with other elements, so copy.
+        attributes = dict(self.attributes)
+        old = attributes.get(name)
+        attributes[name] = value
+        self.attributes = attributes
+        index = document_index(self)
+        if index: index.update(self, name, old, value)
+        mark_dirty(self, STYLE_DIRTY | LAYOUT_DIRTY)
+
     def __repr__(self):
         attrs = [" " + k + "=\"" + v + "\"" for k, v  in self.attributes.items()]
         attr_str = ""
@@ -471,15 +959,105 @@ class Element:
             attr_str += attr
         return "<" + self.tag + attr_str + ">"
 
+class Document(Element):
+    # The root element, which also carries the parser's lookup tables, the
+    # sorted rules it was last styled with and the style sharing counters.
+    __slots__ = ("index", "rules", "sharing")
+
+    def __init__(self, tag, attributes, parent):
+        super().__init__(tag, attributes, parent)
+        self.index = DocumentIndex()
+        self.rules = None
+        self.sharing = StyleSharingCache()
+
+class DocumentIndex:
+    # Only attribute text that might hold an id or class is worth parsing.
+    MAYBE_INDEXED = re.compile("id|class", re.IGNORECASE)
+
+    def __init__(self):
+        # id -> first element with it, and tag or class -> every element
+        # with it, in document order (dicts used as ordered sets). Elements
+        # added by mutation go at the end.
+        self.ids = {}
+        self.tags = {}
+        self.classes = {}
+
+    def __repr__(self):
+        return "DocumentIndex(ids={}, tags={}, classes={})".format(
+            len(self.ids), len(self.tags), len(self.classes))
+
+    def add(self, node):
+        self.tags.setdefault(node.tag, {})[node] = None
+        raw = node.raw_attributes
+        if raw is not None and not self.MAYBE_INDEXED.search(raw): return
+        attributes = node.attributes
+        if "id" in attributes:
+            self.ids.setdefault(attributes["id"], node)
+        if "class" in attributes:
+            for name in attributes["class"].split():
+                self.classes.setdefault(name, {})[node] = None
+
+    def remove(self, node):
+        self.tags[node.tag].pop(node, None)
+        raw = node.raw_attributes
+        if raw is not None and not self.MAYBE_INDEXED.search(raw): return
+        self.update(node, "id", node.attributes.get("id"), None)
+        self.update(node, "class", node.attributes.get("class"), None)
+
+    def update(self, node, name, old, new):
+        if name == "id":
+            if old is not None and self.ids.get(old) is node:
+                del self.ids[old]
+            if new is not None:
+                self.ids.setdefault(new, node)
+        elif name == "class":
+            for old_name in (old or "").split():
+                self.classes.get(old_name, {}).pop(node, None)
+            for new_name in (new or "").split():
+                self.classes.setdefault(new_name, {})[node] = None
+
+ATTRIBUTE = re.compile(r"""([^\s=/][^\s=]*)(?:\s*=\s*(?:"([^"]*)"|'([^']*)'|(\S+)))?""")
+
+# Raw attribute name -> interned, case-folded name.
+ATTRIBUTE_NAMES = {}
+
+def parse_attributes(text):
+    if not text: return EMPTY_ATTRIBUTES
+    attributes = {}
+    for key, double, single, bare in ATTRIBUTE.findall(text):
+        name = ATTRIBUTE_NAMES.get(key)
+        if name is None:
+            name = sys.intern(key.casefold())
+            if len(ATTRIBUTE_NAMES) < 10000:
+                ATTRIBUTE_NAMES[key] = name
+        # Groups that didn't take part in the match come back empty.
+        attributes[name] = double or single or bare
+    return attributes or EMPTY_ATTRIBUTES
+
+# Pre-order walks with an explicit stack, so deeply nested pages can't hit
+# the recursion limit and callers can stop as soon as they find what they want.
+def tree_walk(tree):
+    stack = [tree]
+    while stack:
+        node = stack.pop()
+        yield node
+        if node.children:
+            stack.extend(reversed(node.children))
+
+def tree_walk_depth(tree):
+    stack = [(tree, 0)]
+    while stack:
+        node, depth = stack.pop()
+        yield node, depth
+        for child in reversed(node.children):
+            stack.append((child, depth + 1))
+
 def print_tree(node, indent=0):
-    print(" " * indent, node)
-    for child in node.children:
-        print_tree(child, indent + 2)
+    for node, depth in tree_walk_depth(node):
+        print(" " * (indent + 2 * depth), node)
 
 def tree_to_list(tree, list):
-    list.append(tree)
-    for child in tree.children:
-        tree_to_list(child, list)
+    list.extend(tree_walk(tree))
     return list
 
 class HTMLParser:
@@ -491,206 +1069,229 @@ class HTMLParser:
         "base", "basefont", "bgsound", "noscript",
         "link", "meta", "title", "style", "script",
     ]
+    HTML_CHILD_TAGS = ["head", "body", "/html"]
+    DELIMITERS = re.compile("[<>]")
+    # Raw tag name -> interned, case-folded tag name; shared by all parsers.
+    TAG_NAMES = {}
     
-    def __init__(self, body):
+    def __init__(self, body="", lazy_attributes=True):
         self.body = body
+        self.i = 0
         self.unfinished = []
+        # How many elements of each tag are on the unfinished stack.
+        self.open_counts = {}
+        # Leave each element's attributes unparsed until they're first used.
+        self.lazy_attributes = lazy_attributes
+        # Tokenizer state, kept between feed() calls.
+        self.text = ""
+        self.in_comment = False
+        self.in_tag = False
+        self.in_script = False
+        # Characters of text seen so far, to judge when there's enough to paint.
+        self.text_length = 0
+
     def parse(self):
-        text = ""
-        in_comment = False
-        in_tag = False
-        in_script = False
-        for i, c in enumerate(self.body):
-            if in_script: 
-                if c == "<":
-                    if self.body[i+1: i+9] == "/script>":
-                        in_tag = True
-                        in_script = False
-                        if text: self.add_text(text)
-                        text = ""
-                    else:
-                        text += c
-                else:
-                    text += c
-            else: 
-                if c == "<":
-                    if self.body[i+1 : i+4] == "!--":
+        self.tokenize(len(self.body))
+        return self.close()
+
+    def feed(self, data):
+        # The tokenizer looks up to 5 characters back and 8 ahead, so keep a
+        # little of what's already been parsed and leave the tail for later.
+        keep = max(self.i - 5, 0)
+        self.body = self.body[keep:] + data
+        self.i -= keep
+        self.tokenize(len(self.body) - 8)
+
+    def close(self):
+        self.tokenize(len(self.body))
+        if not self.in_tag and self.text:
+            
+            self.add_text(self.text)
+        return self.finish()
+
+    def partial_tree(self):
+        # Nodes are attached to their parents as soon as they're created, so
+        # the root of what has been parsed so far is a complete tree.
+        if not self.unfinished: return None
+        return self.unfinished[0]
+
+    def tokenize(self, end):
+        # Jumps from one interesting character to the next instead of
+        # walking the body a character at a time; text between them is
+        # taken as a single slice.
+        body = self.body
+        text = self.text
+        in_comment = self.in_comment
+        in_tag = self.in_tag
+        in_script = self.in_script
+        i = self.i
+        while i < end:
+            if in_script:
+                # Script contents are raw text up to the closing tag.
+                j = body.find("</script>", i, end + 8)
+                if j == -1:
+                    text += body[i:end]
+                    i = end
+                    break
+                text += body[i:j]
+                in_tag = True
+                in_script = False
+                if text: self.add_text(text)
+                text = ""
+                i = j + 1
+            elif in_comment:
+                # Comments end at "-->", but not the "--" of "<!--" itself.
+                start = max(i - 2, 0)
+                i = end
+                while True:
+                    j = body.find("-->", start, end + 2)
+                    if j == -1: break
+                    k = j + 2
+                    if body[k-4:k-2] != "<!" and body[k-5:k-2] != "<!-":
+                        in_comment = False
+                        in_tag = False
+                        i = k + 1
+                        break
+                    start = j + 1
+            else:
+                match = self.DELIMITERS.search(body, i, end)
+                if match is None:
+                    text += body[i:end]
+                    i = end
+                    break
+                j = match.start()
+                text += body[i:j]
+                if body[j] == "<":
+                    if body[j+1 : j+4] == "!--":
                         in_comment= True
                     in_tag = True
                     if text: self.add_text(text)
                     text = ""
-                elif c == ">":
-                    if self.body[i-2 : i] == "--":
-                        if self.body[i-4:i-2] != "<!" and self.body[i-5:i-2] != "<!-":
-                            in_comment = False
-                            in_tag = False
-                    else:
-                        if not in_comment:
-                            in_tag = False
-                            if text == "script":
-                                in_script = True
-                            elif text == "/script":
-                                in_script = False
-                            self.add_tag(text)
-                            text = ""
+                elif body[j-2 : j] == "--":
+                    if body[j-4:j-2] != "<!" and body[j-5:j-2] != "<!-":
+                        in_comment = False
+                        in_tag = False
                 else:
-                    if not in_comment:
-                        text += c
-        if not in_tag and text:
-            
-            self.add_text(text)
-        return self.finish()
+                    in_tag = False
+                    if text == "script":
+                        in_script = True
+                    elif text == "/script":
+                        in_script = False
+                    self.add_tag(text)
+                    text = ""
+                i = j + 1
+        self.text = text
+        self.in_comment = in_comment
+        self.in_tag = in_tag
+        self.in_script = in_script
+        self.i = max(i, self.i)
     
     def add_text(self, text):
         if text.isspace(): return
         self.implicit_tags(None)
         parent = self.unfinished[-1]
         node = Text(text, parent)
-        parent.children.append(node)
+        parent.add_child(node)
+        self.text_length += len(text)
 
     def add_tag(self, tag):
-        tag, attributes = self.get_attributes(tag)
+        tag, attributes = self.split_tag(tag)
+        if not self.lazy_attributes:
+            attributes = parse_attributes(attributes)
         if tag.startswith("!"): return
         self.implicit_tags(tag)
-        buffer = []
         if tag.startswith("/"):
             if len(self.unfinished) == 1: return
-            node = self.unfinished.pop()
-            parent = self.unfinished[-1]
-            parent.children.append(node)
+            self.pop()
 
         elif tag in self.SELF_CLOSING_TAGS:
             parent = self.unfinished[-1]
             node = Element(tag, attributes, parent)
-            parent.children.append(node)
+            parent.add_child(node)
+            self.unfinished[0].index.add(node)
 
         else:
-            if tag == "p":
-                for i, unfinished_tag in enumerate(self.unfinished):
-                    if unfinished_tag.tag == "p":
-                        if i == len(self.unfinished) - 1:
-                            u_parent = self.unfinished[i-1]
-                            u_parent.children.append(unfinished_tag)
-                            del self.unfinished[i]
-                        else: 
-                            for j in range(len(self.unfinished) - 1, i, -1):
-                                u_parent = self.unfinished[j-1]
-                                u_parent.children.append(self.unfinished[j])
-                                unf = self.unfinished[j]
-                                buffer.append(Element(unf.tag, unf.attributes, unf.parent))
-                                del self.unfinished[j]
-                            u_parent = self.unfinished[i-1]
-                            u_parent.children.append(unfinished_tag)
-                            del self.unfinished[i]
-                parent = self.unfinished[-1] if self.unfinished else None
-                node = Element(tag, attributes, parent)
-                self.unfinished.append(node)
-                while buffer:
-                    self.unfinished.append(buffer.pop())
+            if tag == "p" and self.open_counts.get("p"):
+                # Opening a <p> closes any open <p>; elements opened inside
+                # the outermost one are reopened inside the new one. Walking
+                # down from the top only visits elements that get closed.
+                remaining = self.open_counts["p"]
+                i = len(self.unfinished) - 1
+                while True:
+                    if self.unfinished[i].tag == "p":
+                        remaining -= 1
+                        if remaining == 0: break
+                    i -= 1
+                reopen = [(unf.tag, unf.attributes)
+                          for unf in self.unfinished[i + 1:]]
+                while len(self.unfinished) > i:
+                    self.pop()
+                self.push(tag, attributes)
+                for reopened in reopen:
+                    self.push(*reopened)
                 return
 
-            parent = self.unfinished[-1] if self.unfinished else None
+            self.push(tag, attributes)
+
+    def push(self, tag, attributes):
+        # Elements join their parent right away, rather than when they're
+        # closed, so a half-parsed document is still a well-formed tree.
+        if self.unfinished:
+            parent = self.unfinished[-1]
             node = Element(tag, attributes, parent)
-            self.unfinished.append(node)
+            parent.add_child(node)
+        else:
+            node = Document(tag, attributes, None)
+        self.unfinished.append(node)
+        self.unfinished[0].index.add(node)
+        self.open_counts[tag] = self.open_counts.get(tag, 0) + 1
+
+    def pop(self):
+        node = self.unfinished.pop()
+        self.open_counts[node.tag] -= 1
+        return node
 
     def finish(self):
         if not self.unfinished:
             self.implicit_tags(None)
         while len(self.unfinished) > 1:
-            node = self.unfinished.pop()
-            parent = self.unfinished[-1]
-            parent.children.append(node)
-        return self.unfinished.pop()
+            self.pop()
+        return self.pop()
     
     def get_attributes(self, text):
-        parts = text.split()
-        tag = parts[0].casefold()
-        newText = ""
-        for attr in parts[1:]:
-            newText += attr + " "
-        attributes = {}
-        state = "in_spaces"
-        buffer = ""
-        key = ""
-        doubleQuote = False
-        singleQuote = False
-        for c in newText[:-1]:
-            if c == "\"":
-                if state == "in_quotes":
-                    if singleQuote and not doubleQuote:
-                        buffer += "\""
-                        doubleQuote = not doubleQuote
-                    elif doubleQuote:
-                        attributes[key.casefold()] = buffer
-                        buffer = ""
-                        key = ""
-                        state = "in_spaces"
-                elif state == "in_value":
-                    state = "in_quotes"
-                    doubleQuote = True
-
-
-            elif c == "\'":
-                if state == "in_quotes":
-                    if doubleQuote and not singleQuote:
-                        buffer += "\'"
-                        doubleQuote = False
-                    elif singleQuote:
-                        attributes[key.casefold()] = buffer
-                        buffer = ""
-                        key = ""
-                        state = "in_spaces"
-                
-                elif state == "in_value":
-                    state = "in_quotes"
-                    singleQuote = True
-
-            elif c == "=":
-                if state =="in_key":
-                    state = "in_value"
-                    key = buffer
-                    buffer = ""
-                elif state == "in_spaces":
-                    state = "in_key"
-                    buffer += c
-                else:
-                    buffer += c
-
-            elif c == " ":
-                if state == "in_key":
-                    state = "in_spaces"
-                elif state == "in_value":
-                    attributes[key.casefold()] = buffer
-                    buffer = ""
-                    key = ""
-                    state = "in_spaces"
-                else:
-                    buffer += c
-            else:
-                if state == "in_spaces":
-                    state = "in_key"
-                buffer += c
-        if buffer != "":
-            if key == "":
-                attributes[buffer.casefold()] = key
-            else:
-                attributes[key.casefold()] = buffer
-
-        return tag, attributes
+        tag, rest = self.split_tag(text)
+        return tag, parse_attributes(rest)
+
+    def split_tag(self, text):
+        # Returns the interned tag name and the unparsed attribute text.
+        parts = text.split(None, 1)
+        name = parts[0]
+        tag = self.TAG_NAMES.get(name)
+        if tag is None:
+            tag = sys.intern(name.casefold())
+            if len(self.TAG_NAMES) < 10000:
+                self.TAG_NAMES[name] = tag
+        # Most tags have no attributes, and those skip the lexer entirely.
+        return tag, parts[1] if len(parts) > 1 else ""
     
     def implicit_tags(self, tag):
+        # Only the first couple of levels get implicit tags, so deeper in
+        # the document this is just a length check.
         while True:
-            open_tags = [node.tag for node in self.unfinished]
-            if open_tags == [] and tag != "html":
+            depth = len(self.unfinished)
+            if depth > 2:
+                break
+            elif depth == 0 and tag != "html":
                 self.add_tag("html")
-            elif open_tags == ["html"] \
-            and tag not in ["head", "body", "/html"]:
+            elif depth == 1 and self.unfinished[0].tag == "html" \
+            and tag not in self.HTML_CHILD_TAGS:
                 if tag in self.HEAD_TAGS:
                     self.add_tag("head")
                 else:
                     self.add_tag("body")    
-            elif open_tags == ["html", "head"] and \
-            tag not in ["/head"] + self.HEAD_TAGS:
+            elif depth == 2 and self.unfinished[0].tag == "html" \
+            and self.unfinished[1].tag == "head" \
+            and tag != "/head" and tag not in self.HEAD_TAGS:
                 self.add_tag("/head")
             else:
                 break
@@ -707,6 +1308,13 @@ class TagSelector:
     def matches(self, node):
         return isinstance(node, Element) and self.tag == node.tag
 
+    def compile(self):
+        tag = self.tag
+        return lambda node: node.tag == tag
+
+    def filter_keys(self):
+        return [self.tag]
+
 class CSSParser:
     def __init__(self, s):
         self.s = s
@@ -839,35 +1447,313 @@ class CSSParser:
                     break
         return rules
 
-def style(node, rules):
-    node.style = {}
-    for property, default_value in INHERITED_PROPERTIES.items():
-        if node.parent:
-            node.style[property] = node.parent.style[property]
+# Bloom filter of the tags and classes of a node's ancestors, kept as an
+# int with a couple of bits set per tag or class. A descendant selector
+# whose ancestor parts aren't all in it can't match, without walking up.
+ANCESTOR_FILTER_SIZE = 256
+ANCESTOR_FILTER_BITS = {}
+
+def filter_bits(keys):
+    bits = 0
+    for key in keys:
+        key_bits = ANCESTOR_FILTER_BITS.get(key)
+        if key_bits is None:
+            h = hash(key)
+            key_bits = 1 << h % ANCESTOR_FILTER_SIZE \
+                | 1 << h // ANCESTOR_FILTER_SIZE % ANCESTOR_FILTER_SIZE
+            if len(ANCESTOR_FILTER_BITS) < 10000:
+                ANCESTOR_FILTER_BITS[key] = key_bits
+        bits |= key_bits
+    return bits
+
+def element_filter(node):
+    bits = filter_bits((node.tag,))
+    if node.classes:
+        bits |= filter_bits(["." + name for name in node.classes])
+    return bits
+
+class RuleIndex:
+    # Sorted rules bucketed by the tag or class of the rightmost part of
+    # their selector, so a node only tries rules that could match it.
+    # Rules keep their place in the cascade to merge buckets back in order.
+    # Each entry has the filter bits its ancestors need and a compiled
+    # matcher for whatever the bucket doesn't already guarantee.
+    def __init__(self, rules):
+        self.rules = rules
+        self.tags = {}
+        self.classes = {}
+        self.universal = []
+        # Whether any rule needs the ancestor filter at all.
+        self.filtered = False
+        for position, (selector, body) in enumerate(rules):
+            key = selector
+            required = 0
+            match = None
+            if isinstance(key, DescendantSelector):
+                key = key.descendant
+                required = filter_bits(selector.ancestor.filter_keys())
+                match = match_ancestor(selector.ancestor.compile())
+                self.filtered = True
+            entry = (position, required, match, body)
+            if isinstance(key, TagSelector):
+                self.tags.setdefault(key.tag, []).append(entry)
+            elif isinstance(key, ClassSelector):
+                self.classes.setdefault(key.classname, []).append(entry)
+            else:
+                entry = (position, required, selector.compile(), body)
+                self.universal.append(entry)
+
+    def __repr__(self):
+        return "RuleIndex(rules={}, tags={}, classes={}, universal={})".format(
+            len(self.rules), len(self.tags), len(self.classes),
+            len(self.universal))
+
+    def matching(self, node, ancestors):
+        # Bodies of the rules matching node, in cascade order. ancestors is
+        # the filter of the node's ancestors.
+        if not isinstance(node, Element): return ()
+        buckets = [self.universal] if self.universal else []
+        if node.tag in self.tags:
+            buckets.append(self.tags[node.tag])
+        if self.classes:
+            for name in node.classes:
+                if name in self.classes:
+                    buckets.append(self.classes[name])
+        if not buckets: return ()
+        if len(buckets) == 1:
+            candidates = buckets[0]
         else:
-            node.style[property] = default_value
-    
-    for selector, body in rules:
-        if not selector.matches(node): continue
-        for property, value in body.items():
-            node.style[property] = value
-    
-    if isinstance(node, Element) and "style" in node.attributes:
-        pairs = CSSParser(node.attributes["style"]).body()
-        for property, value in pairs.items():
-             node.style[property] = value
-            
-    if node.style["font-size"].endswith("%"):
-        if node.parent:
-            parent_font_size = node.parent.style["font-size"]
+            candidates = sorted(itertools.chain(*buckets))
+        return [body for position, required, match, body in candidates
+                if required & ancestors == required
+                and (match is None or match(node))]
+
+class StyleSharingCache:
+    # Styles computed during one style() walk, keyed by everything that goes
+    # into them: the tags and classes of the node and its ancestors (all a
+    # selector can test), the parent's style and the inline style. Siblings
+    # and cousins with equal keys get their style without redoing matching,
+    # inheritance and font-size resolution.
+    def __init__(self):
+        # (parent path, tag, classes) -> small int naming that path
+        self.paths = {}
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    def __repr__(self):
+        return "StyleSharingCache(entries={}, hits={}, misses={})".format(
+            len(self.entries), self.hits, self.misses)
+
+    def path(self, parent_path, node):
+        key = (parent_path, node.tag, node.classes)
+        path = self.paths.get(key)
+        if path is None:
+            path = self.paths[key] = len(self.paths)
+        return path
+
+    def key(self, node, path):
+        # Entries only last for one walk, so the cache doesn't keep styles
+        # no node uses any more from being freed.
+        parent_style = node.parent.style if node.parent else None
+        if isinstance(node, Element):
+            return (path, parent_style, node.attributes.get("style"))
+        return (parent_style,)
+
+    def lookup(self, key):
+        style = self.entries.get(key)
+        if style is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return style
+
+    def clear(self):
+        self.paths.clear()
+        self.entries.clear()
+
+def style(node, rules):
+    # rules is the sorted rule list, or a RuleIndex already built from it.
+    if not isinstance(rules, RuleIndex):
+        rules = RuleIndex(rules)
+    if isinstance(node, Document):
+        node.rules = rules
+    chain = []
+    parent = node.parent
+    while parent is not None:
+        chain.append(parent)
+        parent = parent.parent
+    root = chain[-1] if chain else node
+    sharing = root.sharing if isinstance(root, Document) \
+        else StyleSharingCache()
+    ancestors = 0
+    path = None
+    for parent in reversed(chain):
+        path = sharing.path(path, parent)
+        if rules.filtered:
+            ancestors |= element_filter(parent)
+    # Like tree_walk, but each node carries the filter of its ancestors and
+    # the sharing path of its parent.
+    stack = [(node, ancestors, path)]
+    while stack:
+        node, ancestors, path = stack.pop()
+        if isinstance(node, Element):
+            path = sharing.path(path, node)
+        key = sharing.key(node, path)
+        shared = sharing.lookup(key)
+        if shared is None:
+            style_node(node, rules.matching(node, ancestors))
+            sharing.entries[key] = node.style
         else:
-            parent_font_size = INHERITED_PROPERTIES["font-size"]
-        node_pct = float(node.style["font-size"][:-1]) / 100
-        parent_px = float(parent_font_size[:-2])
-        node.style["font-size"] = str(node_pct * parent_px) + "px"
+            node.dirty &= ~STYLE_DIRTY
+            node.style = shared
+        if node.children:
+            if rules.filtered:
+                ancestors |= element_filter(node)
+            stack.extend([(child, ancestors, path)
+                          for child in reversed(node.children)])
+    sharing.clear()
+
+def restyle(node, rules):
+    # Restyles just the subtrees marked STYLE_DIRTY since the last style.
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        if node.dirty & STYLE_DIRTY:
+            style(node, rules)
+        elif node.dirty & DESCENDANT_DIRTY:
+            stack.extend(node.children)
+
+class ComputedStyle:
+    # A node's computed properties. Read like a dict but never changed once
+    # made, so equal styles are interned into one object that every node
+    # styled that way shares (see computed_style).
+    __slots__ = ("properties", "key", "inherited_style", "color",
+                 "background_color", "font_size_px", "font_args",
+                 "font_handle", "width_px", "__weakref__")
+
+    def __init__(self, properties, key):
+        self.properties = properties
+        self.key = key
+        self.inherited_style = None
+        self.color = properties["color"]
+        self.background_color = properties.get("background-color",
+                                               "transparent")
+        # The rest are parsed the first time layout asks for them. width_px
+        # is False until then, since None means auto.
+        self.font_size_px = None
+        self.font_args = None
+        self.font_handle = None
+        self.width_px = False
 
-    for child in node.children:
-        style(child, rules)
+    def __repr__(self):
+        return "ComputedStyle({})".format(self.properties)
+
+    def __getitem__(self, property):
+        return self.properties[property]
+
+    def __contains__(self, property):
+        return property in self.properties
+
+    def __iter__(self):
+        return iter(self.properties)
+
+    def __len__(self):
+        return len(self.properties)
+
+    def get(self, property, default=None):
+        return self.properties.get(property, default)
+
+    def keys(self):
+        return self.properties.keys()
+
+    def items(self):
+        return self.properties.items()
+
+    # The style a child starts from: just the inherited properties. Every
+    # style has all of those, so one with nothing else is passed on as is.
+    @property
+    def inherited(self):
+        if len(self.properties) == len(INHERITED_PROPERTIES):
+            return self
+        if self.inherited_style is None:
+            self.inherited_style = computed_style(
+                {property: self.properties[property]
+                 for property in INHERITED_PROPERTIES})
+        return self.inherited_style
+
+    # Typed values for layout, so nothing parses CSS strings per word.
+    @property
+    def font_size(self):
+        if self.font_size_px is None:
+            self.font_size_px = float(self.properties["font-size"][:-2])
+        return self.font_size_px
+
+    # The get_font arguments: size in points, weight, slant and family.
+    @property
+    def font_key(self):
+        if self.font_args is None:
+            slant = self.properties["font-style"]
+            if slant == "normal": slant = "roman"
+            self.font_args = (int(self.font_size * .75),
+                self.properties["font-weight"], slant,
+                self.properties["font-family"])
+        return self.font_args
+
+    @property
+    def font(self):
+        if self.font_handle is None:
+            self.font_handle = get_font(*self.font_key)
+        return self.font_handle
+
+    # The width in pixels, or None for auto. Negative widths count as auto.
+    @property
+    def width(self):
+        if self.width_px is False:
+            width = self.properties.get("width", "auto")
+            if width == "auto" or float(width[:-2]) < 0:
+                self.width_px = None
+            else:
+                self.width_px = float(width[:-2])
+        return self.width_px
+
+# Every ComputedStyle still in use, keyed by its properties. Styles are made
+# from worker threads too, hence the lock.
+COMPUTED_STYLES = weakref.WeakValueDictionary()
+COMPUTED_STYLES_LOCK = threading.Lock()
+
+def computed_style(properties):
+    key = frozenset(properties.items())
+    with COMPUTED_STYLES_LOCK:
+        style = COMPUTED_STYLES.get(key)
+        if style is None:
+            style = COMPUTED_STYLES[key] = ComputedStyle(properties, key)
+    return style
+
+def style_node(node, bodies):
+    node.dirty &= ~STYLE_DIRTY
+    if node.parent:
+        inherited = node.parent.style.inherited
+    else:
+        inherited = computed_style(dict(INHERITED_PROPERTIES))
+
+    inline = None
+    if isinstance(node, Element) and "style" in node.attributes:
+        inline = CSSParser(node.attributes["style"]).body()
+    if not bodies and not inline:
+        node.style = inherited
+        return
+
+    style = dict(inherited.properties)
+    for body in bodies:
+        style.update(body)
+    if inline:
+        style.update(inline)
+
+    if style["font-size"].endswith("%"):
+        node_pct = float(style["font-size"][:-1]) / 100
+        style["font-size"] = str(node_pct * inherited.font_size) + "px"
+    node.style = computed_style(style)
 
 DEFAULT_STYLE_SHEET = CSSParser(open("browser.css").read()).parse()
 
@@ -890,15 +1776,61 @@ class DescendantSelector:
             node = node.parent
         return False
 
+    def compile(self):
+        descendant = self.descendant.compile()
+        ancestor = match_ancestor(self.ancestor.compile())
+        return lambda node: descendant(node) and ancestor(node)
+
+    def filter_keys(self):
+        return self.ancestor.filter_keys() + self.descendant.filter_keys()
+
+def match_ancestor(match):
+    def matches(node):
+        node = node.parent
+        while node is not None:
+            if match(node): return True
+            node = node.parent
+        return False
+    return matches
+
 def cascade_priority(rule):
     selector, body = rule
     return selector.priority
 
+# Lays out a layout tree without recursing. Each object sets itself up and
+# creates its children in layout_before, then sizes itself from its laid out
+# children in layout_after; siblings go in order, so a block can always read
+# the height of the one before it.
+def layout_tree(root):
+    stack = [(root, False)]
+    while stack:
+        obj, done = stack.pop()
+        if done:
+            obj.layout_after()
+            continue
+        # A block kept from the last layout only moves; what's inside it
+        # is already laid out.
+        if obj.layout_before(): continue
+        stack.append((obj, True))
+        for child in reversed(obj.children):
+            stack.append((child, False))
+
+def shift_layout(obj, dy):
+    # Moves a laid out subtree, along with anything already painted for it.
+    for obj in tree_walk(obj):
+        obj.y += dy
+        if isinstance(obj, BlockLayout) and obj.commands:
+            for cmd in obj.commands:
+                cmd.shift(dy)
+
 class DocumentLayout:
     def __init__(self, node):
         self.node = node
         self.parent = None
         self.children = []
+        # DOM node -> the block it was laid out in.
+        self.blocks = {}
+        self.commands = None
         self.x = None
         self.y = None
         self.width = None
@@ -908,14 +1840,57 @@ class DocumentLayout:
         return "DocumentLayout()"
 
     def layout(self):
+        layout_tree(self)
+
+    def layout_before(self):
         child = BlockLayout(self.node, self, None)
         self.children.append(child)
         self.display_list = child.display_list
         self.width = WIDTH - 2*HSTEP
         self.x = HSTEP
         self.y = VSTEP
-        child.layout()
-        self.height = child.height
+
+    def layout_after(self):
+        self.height = self.children[0].height
+
+    def relayout(self):
+        # Finds the smallest blocks holding each dirty node and lays just
+        # those out again, innermost first, clearing the dirty bits.
+        targets = {}
+        stack = [self.node]
+        while stack:
+            node = stack.pop()
+            dirty = node.dirty
+            node.dirty = 0
+            if dirty & DESCENDANT_DIRTY:
+                stack.extend(node.children)
+            if not dirty & (LAYOUT_DIRTY | CHILDREN_DIRTY): continue
+            block = self.block_for(node)
+            if block is None: continue
+            targets[block] = targets.get(block, False) or \
+                bool(dirty & LAYOUT_DIRTY)
+        order = []
+        for block, full in targets.items():
+            depth = 0
+            parent = block.parent
+            while parent is not None:
+                # Anything inside a block that's redone in full goes with it.
+                if targets.get(parent): break
+                depth += 1
+                parent = parent.parent
+            else:
+                order.append((depth, block, full))
+        order.sort(key=lambda item: -item[0])
+        for depth, block, full in order:
+            block.relayout(keep_children=not full)
+
+    def block_for(self, node):
+        while node is not None:
+            if node in self.blocks: return self.blocks[node]
+            # Nothing in the head is laid out.
+            if isinstance(node, Element) and node.tag == "head": return None
+            node = node.parent
+        return None
 
     def paint(self):
         return []
@@ -953,6 +1928,14 @@ class BlockLayout:
         self.parent = parent
         self.previous = previous
         self.children = []
+        self.blocks = parent.blocks
+        for node in self.nodes:
+            self.blocks[node] = self
+        self.commands = None
+        # Set while relaying out: old child blocks that may be kept, and
+        # on each kept block, that it should just be moved into place.
+        self.reuse = None
+        self.kept = False
         self.display_list = []
         self.x = None
         self.y = None
@@ -973,8 +1956,7 @@ class BlockLayout:
     def paint(self):
         cmds = []
 
-        bgcolor = self.nodes[0].style.get("background-color",
-                                      "transparent")
+        bgcolor = self.nodes[0].style.background_color
         if bgcolor != "transparent":
             x2, y2 = self.x + self.width, self.y + self.height
             rect = DrawRect(self.self_rect(), bgcolor)
@@ -1001,24 +1983,28 @@ class BlockLayout:
         return cmds
 
     def layout(self):
+        layout_tree(self)
+
+    def layout_before(self):
         if self.previous:
-            self.y = self.previous.y + self.previous.height
+            y = self.previous.y + self.previous.height
         else:
-            self.y = self.parent.y
+            y = self.parent.y
+        if self.kept:
+            self.kept = False
+            if y != self.y: shift_layout(self, y - self.y)
+            return True
+        self.y = y
         if isinstance(self.nodes[0], Element) and self.nodes[0].tag == "li":
             self.x = self.parent.x + (2 * HSTEP)
             self.width = self.parent.width - (2 * HSTEP)
         else:
-            width = self.nodes[0].style.get("width", "auto")
+            width = self.nodes[0].style.width
             self.x = self.parent.x 
-            if width == "auto":
+            if width is None:
                 self.width = self.parent.width
             else:
-                widthAsFloat = float(width[:-2])
-                if widthAsFloat < 0:
-                    self.width = self.parent.width
-                else:
-                    self.width = widthAsFloat
+                self.width = width
             # self.x = self.parent.x
             # self.width = self.parent.width
         mode = self.layout_mode()
@@ -1040,7 +2026,12 @@ class BlockLayout:
                     buffer.append(child)
                     continue
                     
-                next = BlockLayout(child, self, previous)
+                next = self.reuse.pop(child, None) if self.reuse else None
+                if next:
+                    next.previous = previous
+                    next.kept = True
+                else:
+                    next = BlockLayout(child, self, previous)
                 self.children.append(next)
                 previous = next
 
@@ -1065,15 +2056,50 @@ class BlockLayout:
                 self.recurse(node)
             
             # self.flush()
-        for child in self.children:
-            child.layout()
-        
-        # New
+
+    def layout_after(self):
         self.height = sum([child.height for child in self.children])
 
         # for child in self.children:
         #     self.display_list.extend(child.display_list)
 
+    def relayout(self, keep_children=False):
+        old_children = self.children
+        old_height = self.height
+        self.reuse = {}
+        if keep_children:
+            # Only the child list changed, so blocks for elements that are
+            # still children can stay as they are, apart from moving.
+            for child in old_children:
+                if isinstance(child, BlockLayout) and len(child.nodes) == 1 \
+                    and isinstance(child.node, Element) \
+                    and child.node.tag in BLOCK_ELEMENTS:
+                    self.reuse[child.node] = child
+        self.children = []
+        self.commands = None
+        layout_tree(self)
+        self.reuse = None
+        kept = set(self.children)
+        for child in old_children:
+            if child in kept: continue
+            for obj in tree_walk(child):
+                if not isinstance(obj, BlockLayout): continue
+                for node in obj.nodes:
+                    if self.blocks.get(node) is obj: del self.blocks[node]
+
+        # Everything after this block moves by however much it grew, and
+        # blocks around it paint their backgrounds at the new height.
+        delta = self.height - old_height
+        if not delta: return
+        child, parent = self, self.parent
+        while parent is not None:
+            parent.layout_after()
+            parent.commands = None
+            later = parent.children[parent.children.index(child) + 1:]
+            for sibling in later:
+                shift_layout(sibling, delta)
+            child, parent = parent, parent.parent
+
     def layout_mode(self):
         if len(self.nodes) > 1:
             return "inline"
@@ -1131,25 +2157,18 @@ class BlockLayout:
             self.abbr = False
         
     def recurse(self, node):
-        if isinstance(node, Text):
-            for word in node.text.split():
-                self.word(node, word)
-        else:
-            if node.tag == "br":
+        for node in tree_walk(node):
+            if isinstance(node, Text):
+                for word in node.text.split():
+                    self.word(node, word)
+            elif node.tag == "br":
                 self.new_line()
-            for child in node.children:
-                self.recurse(child)
 
 
     def word(self, node, word):
-        family = node.style["font-family"]
-        color = node.style["color"]
-        weight = node.style["font-weight"]
-        style = node.style["font-style"]
-        if style == "normal": style = "roman"
-        size = int(float(node.style["font-size"][:-2]) * .75)
-        font = get_font(size, weight, style, family)
-        color = node.style["color"]
+        size, weight, style, family = node.style.font_key
+        font = node.style.font
+        color = node.style.color
         # if self.abbr:
         #     font = get_font(size//2, "bold", style, family)
         # else:
@@ -1267,6 +2286,9 @@ class LineLayout:
             self.x, self.y, self.width, self.height)
     
     def layout(self):
+        layout_tree(self)
+
+    def layout_before(self):
         self.width = self.parent.width
         self.x = self.parent.x
 
@@ -1278,9 +2300,7 @@ class LineLayout:
         else:
             self.y = self.parent.y
 
-        for word in self.children:
-            word.layout()
-
+    def layout_after(self):
         # print("WTF:", [word.font.metrics("ascent") for word in self.children])
         if not self.children:
             self.height = 0
@@ -1312,12 +2332,10 @@ class TextLayout:
             self.x, self.y, self.width, self.height, self.word)
 
     def layout(self):
-        weight = self.node.style["font-weight"]
-        style = self.node.style["font-style"]
-        family = self.node.style["font-family"]
-        if style == "normal": style = "roman"
-        size = int(float(self.node.style["font-size"][:-2]) * .75)
-        self.font = get_font(size, weight, style, family)
+        layout_tree(self)
+
+    def layout_before(self):
+        self.font = self.node.style.font
 
         self.width = self.font.measure(self.word)
 
@@ -1332,8 +2350,11 @@ class TextLayout:
         # print("X:", self.x)
         # print("height:", self.height)
 
+    def layout_after(self):
+        pass
+
     def paint(self):
-        color = self.node.style["color"]
+        color = self.node.style.color
         return [DrawText(self.x, self.y, self.word, self.font, color)]
 
 class ClassSelector:
@@ -1344,9 +2365,15 @@ class ClassSelector:
         return "ClassSelector(classname={}, priority={})".format(
         self.classname, self.priority) 
     def matches(self, node):
-        nodeClasses = node.attributes.get("class","")
-        Split_node_classes = nodeClasses.split()
-        return isinstance(node, Element) and self.classname in Split_node_classes
+        if not isinstance(node, Element): return False
+        return self.classname in node.classes
+
+    def compile(self):
+        classname = self.classname
+        return lambda node: classname in node.classes
+
+    def filter_keys(self):
+        return ["." + self.classname]
 
 class DrawText:
     def __init__(self, x1, y1, text, font, color):
@@ -1361,6 +2388,13 @@ class DrawText:
     def __repr__(self):
         return "DrawText(top={} left={} bottom={} text={} font={})" \
             .format(self.top, self.left, self.bottom, self.text, self.font)
+
+    def shift(self, dy):
+        self.top += dy
+        self.bottom += dy
+        self.rect.top += dy
+        self.rect.bottom += dy
+
     def execute(self, scroll, canvas):
         canvas.create_text(
             self.left, self.top - scroll,
@@ -1389,6 +2423,13 @@ class DrawRect:
     def __repr__(self):
         return "DrawRect(top={} left={} bottom={} right={} color={})".format(
             self.top, self.left, self.bottom, self.right, self.color)
+
+    def shift(self, dy):
+        self.top += dy
+        self.bottom += dy
+        self.rect.top += dy
+        self.rect.bottom += dy
+
     def execute(self, scroll, canvas):
         canvas.create_rectangle(
             self.left, self.top - scroll,
@@ -1397,9 +2438,22 @@ class DrawRect:
             fill=self.color)
 
 def paint_tree(layout_object, display_list):
-        display_list.extend(layout_object.paint())
-        for child in layout_object.children:
-            paint_tree(child, display_list)
+    # Each block keeps the commands for itself and its lines of text until
+    # relayout redoes it, so only blocks are visited for the rest.
+    stack = [layout_object]
+    while stack:
+        obj = stack.pop()
+        inline = obj.children and isinstance(obj.children[0], LineLayout)
+        if obj.commands is None:
+            commands = obj.paint()
+            if inline:
+                for line in obj.children:
+                    for text in line.children:
+                        commands.extend(text.paint())
+            obj.commands = commands or ()
+        display_list.extend(obj.commands)
+        if not inline:
+            stack.extend(reversed(obj.children))
 
 def get_font(size, weight, slant, family):
     key = (size, weight, slant, family)
@@ -1410,10 +2464,579 @@ def get_font(size, weight, slant, family):
         FONTS[key] = (font, label)
     return FONTS[key][0]
 
+BODY_CHUNK_SIZE = 64 * 1024
+
+def read_length(file, length):
+    # Reads a body of a known length, or up to EOF if length is None.
+    # read1 returns whatever has arrived instead of waiting for a full
+    # chunk, so a slow body is yielded as it trickles in.
+    while length is None or length > 0:
+        size = BODY_CHUNK_SIZE if length is None else min(length, BODY_CHUNK_SIZE)
+        chunk = file.read1(size)
+        if not chunk:
+            if length is not None:
+                raise ConnectionError("connection closed mid-body")
+            return
+        if length is not None:
+            length -= len(chunk)
+        yield chunk
+
+def read_exact(file, length):
+    # Reads into a preallocated buffer through a memoryview; big reads go
+    # straight from the socket (recv_into) without intermediate copies.
+    # Yields the buffer as the only chunk, so like the other readers it
+    # reads nothing until the body is iterated.
+    buffer = bytearray(length)
+    view = memoryview(buffer)
+    pos = 0
+    while pos < length:
+        n = file.readinto(view[pos:])
+        if not n:
+            raise ConnectionError("connection closed mid-body")
+        pos += n
+    yield buffer
+
+def read_mapped(path):
+    # Yields a local file as slices of a read-only memory map. Slicing a
+    # memoryview copies nothing, and pages already parsed can be dropped
+    # by the OS, so the file never sits in memory as one big string.
+    with open(path, "rb") as file:
+        size = os.fstat(file.fileno()).st_size
+        if size == 0: return
+        mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    if hasattr(mmap, "MADV_SEQUENTIAL"):
+        mapped.madvise(mmap.MADV_SEQUENTIAL)
+    # The map keeps its own handle, and is unmapped once the last slice of
+    # it is dropped, which is after the decoder is done with it.
+    view = memoryview(mapped)
+    for pos in range(0, size, BODY_CHUNK_SIZE):
+        yield view[pos:pos + BODY_CHUNK_SIZE]
+
+def read_chunked(file):
+    while True:
+        line = file.readline()
+        if not line:
+            raise ConnectionError("connection closed mid-body")
+        # Chunk extensions after ";" are allowed and ignored.
+        size = int(line.split(b";", 1)[0].strip(), 16)
+        if size == 0: break
+        yield from read_length(file, size)
+        file.readline()
+    # Skip any trailer headers up to the blank line ending the message.
+    while file.readline() not in (b"\r\n", b"\n", b""):
+        pass
+
+def decompress(chunks, encoding):
+    if encoding == "identity":
+        yield from chunks
+        return
+    if encoding in ("gzip", "x-gzip"):
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    elif encoding == "deflate":
+        decompressor = None
+    else:
+        raise Exception("Unsupported content-encoding: " + encoding)
+    for chunk in chunks:
+        if decompressor is None:
+            # "deflate" should be zlib-wrapped, but some servers send raw
+            # deflate data, so sniff the zlib header on the first chunk.
+            wrapped = len(chunk) >= 2 and (chunk[0] & 0x0f) == 8 \
+                and ((chunk[0] << 8) | chunk[1]) % 31 == 0
+            decompressor = zlib.decompressobj(
+                zlib.MAX_WBITS if wrapped else -zlib.MAX_WBITS)
+        data = decompressor.decompress(chunk)
+        if data: yield data
+    if decompressor is not None:
+        data = decompressor.flush()
+        if data: yield data
+
+CHARSET_SNIFF_LENGTH = 1024
+META_CHARSET = re.compile(
+    rb"""<meta[^>]+charset\s*=\s*["']?\s*([-\w.:]+)""", re.IGNORECASE)
+
+def content_type_charset(content_type):
+    for param in content_type.split(";")[1:]:
+        name, _, value = param.partition("=")
+        if name.strip().casefold() == "charset":
+            return value.strip().strip('"\'') or None
+    return None
+
+def decode_body(chunks, charset=None):
+    # Without a charset from the headers, look for <meta charset> near the
+    # start of the document, falling back to utf8.
+    if charset is None:
+        head = []
+        size = 0
+        for chunk in chunks:
+            head.append(chunk)
+            size += len(chunk)
+            if size >= CHARSET_SNIFF_LENGTH: break
+        start = b"".join(c[:CHARSET_SNIFF_LENGTH] for c in head)
+        match = META_CHARSET.search(start[:CHARSET_SNIFF_LENGTH])
+        if match: charset = match.group(1).decode("ascii")
+        chunks = itertools.chain(head, chunks)
+    try:
+        decoder = codecs.getincrementaldecoder(charset or "utf8")(errors="replace")
+    except LookupError:
+        decoder = codecs.getincrementaldecoder("utf8")(errors="replace")
+    for chunk in chunks:
+        text = decoder.decode(chunk)
+        if text: yield text
+    text = decoder.decode(b"", final=True)
+    if text: yield text
+
+class Connection:
+    def __init__(self, key, sock):
+        self.key = key
+        self.sock = sock
+        self.file = sock.makefile("rb")
+        self.last_used = time.monotonic()
+        self.reused = False
+
+    def __repr__(self):
+        return "Connection(key={}, reused={})".format(self.key, self.reused)
+
+    def is_stale(self):
+        # An idle keep-alive socket has nothing to read. If select says it
+        # is readable, the server closed it (or sent junk), so it's unusable.
+        try:
+            readable, _, _ = select.select([self.sock], [], [], 0)
+        except (OSError, ValueError):
+            return True
+        return bool(readable)
+
+    def close(self):
+        try:
+            self.file.close()
+            self.sock.close()
+        except OSError:
+            pass
+
+class ConnectionPool:
+    def __init__(self, max_per_host=6, idle_timeout=30):
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+        self.dns = DNSCache()
+        self.tls = TLSCache()
+        # (scheme, host, port) -> idle connections, most recently used last
+        self.idle = {}
+        # (scheme, host, port) -> number of connections currently checked out
+        self.in_use = {}
+        self.lock = threading.Lock()
+        self.available = threading.Condition(self.lock)
+        self.hits = 0
+        self.misses = 0
+
+    def __repr__(self):
+        return "ConnectionPool(idle={}, in_use={}, hits={}, misses={})".format(
+            sum(len(conns) for conns in self.idle.values()),
+            sum(self.in_use.values()), self.hits, self.misses)
+
+    def acquire(self, scheme, host, port, fresh=False):
+        key = (scheme, host, port)
+        with self.available:
+            while True:
+                self.prune()
+                idle = self.idle.get(key, [])
+                while idle and not fresh:
+                    conn = idle.pop()
+                    if conn.is_stale():
+                        conn.close()
+                        continue
+                    conn.reused = True
+                    self.in_use[key] = self.in_use.get(key, 0) + 1
+                    self.hits += 1
+                    return conn
+                if self.in_use.get(key, 0) < self.max_per_host:
+                    self.in_use[key] = self.in_use.get(key, 0) + 1
+                    self.misses += 1
+                    break
+                self.available.wait()
+
+        # Connecting can take a while, so don't hold the lock for it.
+        try:
+            sock = self.connect(scheme, host, port)
+        except:
+            with self.available:
+                self.in_use[key] -= 1
+                self.available.notify()
+            raise
+        return Connection(key, sock)
+
+    def release(self, conn, reusable):
+        if reusable and isinstance(conn.sock, ssl.SSLSocket):
+            self.tls.remember(conn.sock, conn.key[1])
+        with self.available:
+            self.in_use[conn.key] -= 1
+            if reusable:
+                conn.last_used = time.monotonic()
+                self.idle.setdefault(conn.key, []).append(conn)
+                # Don't keep more idle sockets around than we'd ever use at once.
+                idle = self.idle[conn.key]
+                while len(idle) > self.max_per_host:
+                    idle.pop(0).close()
+            else:
+                conn.close()
+            self.available.notify()
+
+    def prune(self):
+        now = time.monotonic()
+        for key, idle in self.idle.items():
+            while idle and now - idle[0].last_used > self.idle_timeout:
+                idle.pop(0).close()
+
+    def close_all(self):
+        with self.available:
+            for idle in self.idle.values():
+                for conn in idle:
+                    conn.close()
+            self.idle.clear()
+
+    def connect(self, scheme, host, port):
+        address = self.dns.resolve(host, port)
+        s = socket.socket(
+            family=socket.AF_INET,
+            type=socket.SOCK_STREAM,
+            proto=socket.IPPROTO_TCP,
+        )
+
+        # Creates secure port connection if https scheme used.
+        if scheme == "https":
+            s = self.tls.wrap(s, host)
+        try:
+            s.connect(address)
+        except OSError:
+            s.close()
+            # The address may have moved; look it up again next time.
+            self.dns.forget(host, port)
+            raise
+        if scheme == "https":
+            self.tls.handshake_done(s, host)
+        return s
+
+class DNSCache:
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        # (host, port) -> (address, expiry time)
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __repr__(self):
+        return "DNSCache(entries={}, hits={}, misses={})".format(
+            len(self.entries), self.hits, self.misses)
+
+    def resolve(self, host, port):
+        key = (host, port)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and time.monotonic() < entry[1]:
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+        infos = socket.getaddrinfo(host, port, socket.AF_INET, socket.SOCK_STREAM)
+        address = infos[0][4]
+        with self.lock:
+            self.entries[key] = (address, time.monotonic() + self.ttl)
+        return address
+
+    def forget(self, host, port):
+        with self.lock:
+            self.entries.pop((host, port), None)
+
+class TLSCache:
+    def __init__(self):
+        # Loading the CA bundle is slow, so one context serves every request.
+        self.context = None
+        # host -> last TLS session, offered again to skip a full handshake
+        self.sessions = {}
+        self.lock = threading.Lock()
+        self.context_hits = 0
+        self.context_misses = 0
+        self.session_hits = 0
+        self.session_misses = 0
+
+    def __repr__(self):
+        return ("TLSCache(context_hits={}, context_misses={}, " + \
+            "session_hits={}, session_misses={})").format(
+            self.context_hits, self.context_misses,
+            self.session_hits, self.session_misses)
+
+    def get_context(self):
+        with self.lock:
+            if self.context is None:
+                self.context_misses += 1
+                self.context = ssl.create_default_context()
+            else:
+                self.context_hits += 1
+            return self.context
+
+    def wrap(self, s, host):
+        ctx = self.get_context()
+        with self.lock:
+            session = self.sessions.get(host)
+        return ctx.wrap_socket(s, server_hostname=host, session=session)
+
+    def handshake_done(self, s, host):
+        with self.lock:
+            if s.session_reused:
+                self.session_hits += 1
+            else:
+                self.session_misses += 1
+        self.remember(s, host)
+
+    def remember(self, s, host):
+        # Called after the handshake, and again once a response has been
+        # read, since TLS 1.3 servers send session tickets after the handshake.
+        if s.session is None: return
+        with self.lock:
+            self.sessions[host] = s.session
+
+class CacheEntry:
+    def __init__(self, data, compressed, stored, max_age,
+                 etag=None, last_modified=None):
+        # data is the utf8 body, zlib-compressed if compressed is set.
+        self.data = data
+        self.compressed = compressed
+        self.stored = stored
+        self.max_age = max_age
+        self.etag = etag
+        self.last_modified = last_modified
+
+    def __repr__(self):
+        return "CacheEntry(size={}, max_age={}, etag={}, last_modified={})".format(
+            len(self.data), self.max_age, self.etag, self.last_modified)
+
+    @property
+    def body(self):
+        data = zlib.decompress(self.data) if self.compressed else self.data
+        return data.decode("utf8")
+
+    def is_fresh(self):
+        return time.time() - self.stored < self.max_age
+
+    def metadata(self):
+        return {"compressed": self.compressed, "stored": self.stored,
+                "max_age": self.max_age, "etag": self.etag,
+                "last_modified": self.last_modified}
+
+class HTTPCache:
+    def __init__(self, memory_budget=16 * 1024 * 1024,
+                 disk_budget=64 * 1024 * 1024, directory=None, compress=True):
+        self.memory_budget = memory_budget
+        self.disk_budget = disk_budget
+        self.directory = directory
+        self.compress = compress
+        # Both tiers are LRU ordered: least recently used first.
+        self.memory = OrderedDict()
+        self.memory_bytes = 0
+        self.disk = None
+        self.disk_bytes = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __repr__(self):
+        return "HTTPCache(memory={}B, disk={}B, hits={}, misses={})".format(
+            self.memory_bytes, self.disk_bytes, self.hits, self.misses)
+
+    def make_entry(self, body, max_age, etag=None, last_modified=None):
+        data = body.encode("utf8")
+        compressed = False
+        if self.compress:
+            packed = zlib.compress(data)
+            if len(packed) < len(data):
+                data, compressed = packed, True
+        return CacheEntry(data, compressed, time.time(), max_age,
+                          etag, last_modified)
+
+    def max_body_size(self):
+        # Bodies longer than this can't fit in either tier. It's compared
+        # with the body before compression, so it errs on not caching.
+        if self.directory is None:
+            return self.memory_budget
+        return max(self.memory_budget, self.disk_budget)
+
+    def lookup(self, key):
+        with self.lock:
+            entry = self.memory.get(key)
+            if entry is not None:
+                self.memory.move_to_end(key)
+            else:
+                entry = self.disk_lookup(key)
+                if entry is not None:
+                    self.memory_store(key, entry)
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return entry
+
+    def store(self, key, entry):
+        with self.lock:
+            self.memory_store(key, entry)
+            self.disk_store(key, entry)
+
+    def refresh(self, key, entry, max_age):
+        # A 304 says our copy is still good, so restart its freshness clock.
+        entry.stored = time.time()
+        entry.max_age = max_age
+        self.store(key, entry)
+
+    def memory_store(self, key, entry):
+        if key in self.memory:
+            self.memory_bytes -= len(self.memory.pop(key).data)
+        if len(entry.data) > self.memory_budget: return
+        self.memory[key] = entry
+        self.memory_bytes += len(entry.data)
+        while self.memory_bytes > self.memory_budget:
+            _, evicted = self.memory.popitem(last=False)
+            self.memory_bytes -= len(evicted.data)
+
+    def disk_path(self, key):
+        name = hashlib.sha1(key.encode("utf8")).hexdigest()
+        return os.path.join(self.directory, name + ".entry")
+
+    def open_disk(self):
+        # Index the disk tier lazily, oldest access time first.
+        if self.disk is not None: return self.directory is not None
+        self.disk = OrderedDict()
+        if self.directory is None: return False
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            files = []
+            for name in os.listdir(self.directory):
+                if not name.endswith(".entry"): continue
+                path = os.path.join(self.directory, name)
+                stat = os.stat(path)
+                files.append((stat.st_mtime, path, stat.st_size))
+        except OSError:
+            self.directory = None
+            return False
+        for _, path, size in sorted(files):
+            self.disk[path] = size
+            self.disk_bytes += size
+        return True
+
+    def disk_lookup(self, key):
+        if not self.open_disk(): return None
+        path = self.disk_path(key)
+        if path not in self.disk: return None
+        try:
+            with open(path, "rb") as f:
+                metadata = json.loads(f.readline())
+                data = f.read()
+            if metadata.pop("key") != key: return None
+            os.utime(path)
+        except (OSError, ValueError, KeyError):
+            self.disk_remove(path)
+            return None
+        self.disk.move_to_end(path)
+        return CacheEntry(data, **metadata)
+
+    def disk_store(self, key, entry):
+        if not self.open_disk(): return
+        path = self.disk_path(key)
+        metadata = entry.metadata()
+        metadata["key"] = key
+        header = json.dumps(metadata).encode("utf8") + b"\n"
+        size = len(header) + len(entry.data)
+        self.disk_remove(path)
+        if size > self.disk_budget: return
+        try:
+            with open(path, "wb") as f:
+                f.write(header)
+                f.write(entry.data)
+        except OSError:
+            return
+        self.disk[path] = size
+        self.disk_bytes += size
+        while self.disk_bytes > self.disk_budget:
+            self.disk_remove(next(iter(self.disk)))
+
+    def disk_remove(self, path):
+        size = self.disk.pop(path, None)
+        if size is None: return
+        self.disk_bytes -= size
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def clear(self):
+        with self.lock:
+            self.memory.clear()
+            self.memory_bytes = 0
+            if self.open_disk():
+                for path in list(self.disk):
+                    self.disk_remove(path)
+
+def parse_cache_control(value):
+    directives = {}
+    for directive in value.split(","):
+        if not directive.strip(): continue
+        name, _, arg = directive.partition("=")
+        directives[name.strip().casefold()] = arg.strip().strip('"')
+    return directives
+
+def freshness_lifetime(response_headers):
+    # Returns how long a response may be served without revalidating, or
+    # None if it must not be stored at all.
+    directives = parse_cache_control(response_headers.get("cache-control", ""))
+    if "no-store" in directives: return None
+    if "no-cache" in directives: return 0
+    try:
+        return max(float(directives.get("max-age", 0)), 0)
+    except ValueError:
+        return 0
+
+class Fetcher:
+    def __init__(self, workers=8, per_host=4):
+        self.workers = workers
+        self.per_host = per_host
+        self.executor = None
+        # host -> semaphore capping how many fetches hit that host at once
+        self.host_limits = {}
+        self.lock = threading.Lock()
+
+    def __repr__(self):
+        return "Fetcher(workers={}, per_host={})".format(
+            self.workers, self.per_host)
+
+    def fetch_all(self, base, links, browser):
+        # Returns one body per link, in the same order, or None for any
+        # link that couldn't be resolved or fetched.
+        with self.lock:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=self.workers)
+        futures = [self.executor.submit(self.fetch, base, link, browser)
+                   for link in links]
+        return [future.result() for future in futures]
+
+    def fetch(self, base, link, browser):
+        try:
+            url = base.resolve(link)
+            with self.lock:
+                limit = self.host_limits.setdefault(
+                    url.host, threading.Semaphore(self.per_host))
+            with limit:
+                return url.request(browser)
+        except:
+            return None
+
 class URL:
-    # Global caches, stores requests for a specified amount of time.
-    cache = {}
-    cacheTimes = {}
+    # Global cache, shared by every request. Bodies live in memory and on disk.
+    cache = HTTPCache(
+        directory=os.path.join(os.path.expanduser("~"), ".cache", "small_browser"))
+    # Keep-alive sockets shared by every request, keyed by (scheme, host, port).
+    pool = ConnectionPool()
+    # Thread pool for fetching subresources like stylesheets in parallel.
+    fetcher = Fetcher()
+    SCHEME = re.compile(r"[a-zA-Z][a-zA-Z0-9+.-]*:")
+    # Body bytes the last stream() read off the wire or disk, before any
+    # decompression or decoding. Cache hits read none.
+    received = 0
     def __init__(self, url):
         self.scheme, url = url.split("://", 1)
         if "/" in self.scheme:
@@ -1436,6 +3059,8 @@ class URL:
             self.port = 80
         elif self.scheme == "https":
             self.port = 443
+        elif self.scheme == "file":
+            self.port = None
         elif self.scheme == "about":
             self.port = None
             self.host = None
@@ -1454,13 +3079,15 @@ class URL:
             self.scheme, self.host, self.port, self.path, fragment_part)
 
     def request(self, browser, headers = None):
-        s = socket.socket(
-            family=socket.AF_INET,
-            type=socket.SOCK_STREAM,
-            proto=socket.IPPROTO_TCP,
-        )
+        return "".join(self.stream(browser, headers, whole=True))
 
+    def stream(self, browser, headers = None, whole = False, store = True):
+        # Yields the body as text, chunk by chunk, as it comes off the socket.
+        # With whole set, a body of known length is read and decoded in one go.
+        # With store unset, the body is never kept for the cache, so callers
+        # that only pass it along don't hold the whole page in memory.
         request_dictionary = {}
+        self.received = 0
 
         if headers != None:
             for key, value in headers.items():
@@ -1470,24 +3097,27 @@ class URL:
             http_body = "<!doctype html>"
             for bookmark in browser.bookmarks:
                 http_body += f'<a href="{bookmark}">{bookmark}</a><br>'
-            return http_body
+            yield http_body
+            return
 
         if self.scheme == "file":
-            return self.openFile(f"{self.path}")
+            yield from self.openFile(f"{self.path}")
+            return
 
-        # Creates secure port connection if https scheme used.
-        if self.scheme == "https":
-            ctx = ssl.create_default_context()
-            s = ctx.wrap_socket(s, server_hostname=self.host)
-        s.connect((self.host, self.port))
-
-        # Retreives information from cache if available.
-        if self.cache:
-            key = f"{self.scheme}://{self.host}:{self.port}{self.path}"
-            if key in self.cache.keys() :
-                secDifference = datetime.now() - self.cacheTimes[key][0]
-                if secDifference.total_seconds() < self.cacheTimes[key][1]:
-                    return self.cache[key]
+        # Retreives information from cache if available, before connecting.
+        cache_key = f"{self.scheme}://{self.host}:{self.port}{self.path}"
+        entry = self.cache.lookup(cache_key)
+        if entry is not None:
+            if entry.is_fresh():
+                yield entry.body
+                return
+            # Stale, but the server can tell us it hasn't changed.
+            if entry.etag and "if-none-match" not in request_dictionary:
+                request_dictionary["if-none-match"] = entry.etag
+            if entry.last_modified and "if-modified-since" not in request_dictionary:
+                request_dictionary["if-modified-since"] = entry.last_modified
+
+        conn = self.pool.acquire(self.scheme, self.host, self.port)
 
         requestString = "GET {} HTTP/1.1\r\n".format(self.path) + \
                         "host: {}\r\n".format(self.host)
@@ -1498,73 +3128,138 @@ class URL:
                 requestString += f"{key}: {value}\r\n"
 
         if "connection" not in requestString:
-            requestString += "connection: close\r\n"
+            requestString += "connection: keep-alive\r\n"
         if "user-agent" not in requestString:
             requestString += "user-agent: Mack\r\n"
+        if "accept-encoding" not in requestString:
+            requestString += "accept-encoding: gzip, deflate\r\n"
         requestString += "\r\n"
 
-        s.send((requestString)
-               .encode("utf8"))
-        
-        response = s.makefile("r", encoding="utf8", newline="\r\n")
-        statusline = response.readline()
-        version, status, explanation = statusline.split(" ", 2)
-
-        
-
-        response_headers = {}
+        # A pooled socket can be closed by the server at any moment, so if
+        # a reused one fails before we get a status line, try a fresh one.
         while True:
-            line = response.readline()
-            if line == "\r\n": break
-            header, value = line.split(":", 1)
-            response_headers[header.casefold()] = value.strip()
-
-        assert "transfer-encoding" not in response_headers
-        assert "content-encoding" not in response_headers
-
-        body = response.read()
-        s.close()
+            try:
+                conn.sock.sendall(requestString.encode("utf8"))
+                statusline = conn.file.readline().decode("latin1")
+                if not statusline:
+                    raise ConnectionError("connection closed by server")
+                break
+            except OSError:
+                self.pool.release(conn, False)
+                if not conn.reused: raise
+                conn = self.pool.acquire(self.scheme, self.host, self.port,
+                                         fresh=True)
+        # Anything that goes wrong from here on, including a malformed
+        # response, must still give the connection back to the pool.
+        try:
+            version, status, explanation = statusline.split(" ", 2)
+
+            response_headers = {}
+            while True:
+                line = conn.file.readline().decode("latin1")
+                if line in ("\r\n", "\n", ""): break
+                header, value = line.split(":", 1)
+                response_headers[header.casefold()] = value.strip()
+
+            # Keep-alive needs the body framed by content-length or chunks,
+            # otherwise the server marks the end of the body by closing the socket.
+            reusable = version == "HTTP/1.1" and \
+                response_headers.get("connection", "").casefold() != "close"
+            transfer_encoding = response_headers.get("transfer-encoding", "").casefold()
+            if status.startswith("1") or status in ("204", "304"):
+                chunks = iter([])
+            elif transfer_encoding:
+                if transfer_encoding != "chunked":
+                    raise Exception("Unsupported transfer-encoding: " + transfer_encoding)
+                chunks = read_chunked(conn.file)
+            elif "content-length" in response_headers:
+                length = int(response_headers["content-length"])
+                if whole:
+                    # The whole body is wanted at once, so read it straight into
+                    # one buffer of the right size instead of chunk by chunk.
+                    chunks = read_exact(conn.file, length)
+                else:
+                    chunks = read_length(conn.file, length)
+            else:
+                chunks = read_length(conn.file, None)
+                reusable = False
+            content_encoding = response_headers.get("content-encoding", "identity")
+            chunks = decompress(self.count_received(chunks),
+                                content_encoding.casefold())
+
+            max_age = freshness_lifetime(response_headers)
+            etag = response_headers.get("etag")
+            last_modified = response_headers.get("last-modified")
+            # With no validators and no freshness, an entry is never usable.
+            cacheable = store and status == "200" and max_age is not None and \
+                (max_age > 0 or etag or last_modified)
+            # Redirect and 304 bodies aren't the page we asked for.
+            redirect = status.startswith("3") and "location" in response_headers
+            passthrough = not redirect and status != "304"
+
+            charset = content_type_charset(response_headers.get("content-type", ""))
+            body = []
+            body_size = 0
+            max_body_size = self.cache.max_body_size()
+            for text in decode_body(chunks, charset):
+                if cacheable:
+                    body_size += len(text)
+                    if body_size > max_body_size:
+                        # Too big to cache, so stop holding on to it.
+                        cacheable = False
+                        body = []
+                    else:
+                        body.append(text)
+                if passthrough: yield text
+        except:
+            self.pool.release(conn, False)
+            raise
+        self.pool.release(conn, reusable)
 
         # Adds to cache if applicable.
-        if status.startswith("2"):
-            
-            if "cache-control" in response_headers:
-                if "max-age" in response_headers["cache-control"]:
-                    key = f"{self.scheme}://{self.host}:{self.port}{self.path}"
-                    timeAgePair = (datetime.now(), float(response_headers["cache-control"].split("=")[1]))
-                    self.cache[key] = body
-                    self.cacheTimes[key] = timeAgePair
+        if status == "304" and entry is not None:
+            self.cache.refresh(cache_key, entry, max_age or 0)
+            yield entry.body
+        elif cacheable:
+            self.cache.store(cache_key, self.cache.make_entry(
+                "".join(body), max_age, etag, last_modified))
 
         # Redirects if applicable.
-        if status.startswith("3") and "location" in response_headers.keys():
+        if redirect:
             location = response_headers["location"]
             if location.startswith("/"):
-                return URL(f"{self.scheme}://{self.host}{location}").request()
+                target = URL(f"{self.scheme}://{self.host}:{self.port}{location}")
             else:
-                return URL(location).request()
-
-        return body
+                target = URL(location)
+            yield from target.stream(browser, store=store)
+            self.received += target.received
+
+    def count_received(self, chunks):
+        for chunk in chunks:
+            self.received += len(chunk)
+            yield chunk
     
     def openFile(self, url = ""):
         if not os.path.isfile(url):
             raise Exception
-        if url != "":
-            return open(url).read()
+        return decode_body(self.count_received(read_mapped(url)))
         
     def resolve(self, url):
+        if self.SCHEME.match(url) and "://" in url: return URL(url)
         if not url.startswith("/"):
             dir, _ = self.path.rsplit("/", 1)
-            while url.startswith("../"):
-                _, url = url.split("/", 1)
-                if "/" in dir:
+            while url.startswith("../") or url.startswith("./"):
+                segment, url = url.split("/", 1)
+                if segment == ".." and "/" in dir:
                     dir, _ = dir.rsplit("/", 1)
             url = dir + "/" + url
-        if "://" in url: return URL(url)
         if not url.startswith("/"):
             dir, _ = self.path.rsplit("/", 1)
             url = dir + "/" + url
         if url.startswith("//"):
             return URL(self.scheme + ":" + url)
+        elif self.port is None:
+            return URL(self.scheme + "://" + self.host + url)
         else:
             return URL(self.scheme + "://" + self.host + \
                        ":" + str(self.port) + url)
@@ -1575,6 +3270,8 @@ class URL:
             port_part = ""
         if self.scheme == "http" and self.port == 80:
             port_part = ""
+        if self.port is None:
+            port_part = ""
 
         if self.scheme == "about":
             return "about://" + self.path
@@ -1584,24 +3281,213 @@ class URL:
         else: 
             return self.scheme + "://" + self.host + port_part + self.path
     
+RAW_TEXT_END = {
+    "script": re.compile("</script", re.IGNORECASE),
+    "style": re.compile("</style", re.IGNORECASE),
+}
+# Longest entity worth holding back when a chunk ends partway through one.
+ENTITY_LENGTH = 32
+TEXT_BUFFER_SIZE = 64 * 1024
+
+def extract_text(chunks):
+    # Yields the text of a document chunk by chunk, without building a
+    # DOM. Only an unfinished tag name, entity or end marker is carried
+    # from one chunk to the next, so memory stays bounded on any input.
+    mode = "text"
+    tag_head = ""
+    raw_end = None
+    pending = ""
+    for chunk in chunks:
+        data = pending + chunk
+        pending = ""
+        i, n = 0, len(data)
+        while i < n:
+            if mode == "text":
+                j = data.find("<", i)
+                if j == -1:
+                    k = data.rfind("&", max(i, n - ENTITY_LENGTH))
+                    if k != -1 and ";" not in data[k:]:
+                        pending = data[k:]
+                        n = k
+                    if i < n: yield html.unescape(data[i:n])
+                    break
+                if i < j: yield html.unescape(data[i:j])
+                if n - j < 4:
+                    # Not enough yet to tell a comment from a tag.
+                    pending = data[j:]
+                    break
+                if data.startswith("<!--", j):
+                    mode = "comment"
+                    i = j + 4
+                else:
+                    mode = "tag"
+                    tag_head = ""
+                    i = j + 1
+            elif mode == "comment":
+                j = data.find("-->", i)
+                if j == -1:
+                    pending = data[max(i, n - 2):]
+                    break
+                mode = "text"
+                i = j + 3
+            elif mode == "tag":
+                # Only the start of a tag is kept, enough for its name.
+                j = data.find(">", i)
+                tag_head = (tag_head + data[i:n if j == -1 else j])[:16]
+                if j == -1: break
+                name = tag_head.split(None, 1)[0].casefold() if tag_head.strip() else ""
+                raw_end = RAW_TEXT_END.get(name.rstrip("/"))
+                mode = "raw" if raw_end and not name.endswith("/") else "text"
+                i = j + 1
+            else:
+                # Script and style contents run to their closing tag.
+                match = raw_end.search(data, i)
+                if match is None:
+                    pending = data[max(i, n - 8):]
+                    break
+                mode = "tag"
+                tag_head = ""
+                i = match.start() + 1
+    if mode == "text" and pending and not pending.startswith("<"):
+        yield html.unescape(pending)
+
+def write_text(pieces, out=None):
+    out = out or sys.stdout
+    buffer = []
+    size = 0
+    for piece in pieces:
+        buffer.append(piece)
+        size += len(piece)
+        if size >= TEXT_BUFFER_SIZE:
+            out.write("".join(buffer))
+            buffer = []
+            size = 0
+    out.write("".join(buffer))
+    out.flush()
+
 def show(body):
-    in_tag = False
-    for c in body:
-        if c == "<":
-            in_tag = True
-        elif c == ">":
-            in_tag = False
-        elif not in_tag:
-            print(c, end="")
+    write_text(extract_text([body]))
 
 def load(url):
-    body = url.request()
-    show(body)
+    write_text(extract_text(url.stream(None, store=False)))
+
+class Crawler:
+    def __init__(self, workers=8, max_depth=3, max_pages=100, same_host=True):
+        self.workers = workers
+        self.max_depth = max_depth
+        self.max_pages = max_pages
+        # Only follow links to the seed's scheme, host and port.
+        self.same_host = same_host
+        self.pages = 0
+        self.bytes = 0
+        self.errors = 0
+        self.elapsed = 0
+
+    def __repr__(self):
+        return "Crawler(pages={}, bytes={}, errors={}, elapsed={:.2f})".format(
+            self.pages, self.bytes, self.errors, self.elapsed)
+
+    def key(self, url):
+        # Fragments and default ports don't make a different page.
+        return f"{url.scheme}://{(url.host or '').casefold()}:{url.port}{url.path}"
+
+    def crawl(self, seed, report=None):
+        # Breadth first from seed, with up to `workers` pages in flight.
+        # report(url, size, error) is called as each page finishes.
+        start = time.monotonic()
+        origin = (seed.scheme, seed.host, seed.port)
+        seen = {self.key(seed)}
+        frontier = deque([(seed, 0)])
+        in_flight = {}
+        submitted = 0
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            while frontier or in_flight:
+                while frontier and len(in_flight) < self.workers \
+                    and submitted < self.max_pages:
+                    url, depth = frontier.popleft()
+                    in_flight[executor.submit(self.visit, url)] = (url, depth)
+                    submitted += 1
+                if not in_flight: break
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    url, depth = in_flight.pop(future)
+                    try:
+                        size, links = future.result()
+                    except Exception as e:
+                        self.errors += 1
+                        if report: report(url, None, e)
+                        continue
+                    self.pages += 1
+                    self.bytes += size
+                    if report: report(url, size, None)
+                    if depth >= self.max_depth: continue
+                    for href in links:
+                        if href.startswith("#"): continue
+                        if URL.SCHEME.match(href) and "://" not in href: continue
+                        try:
+                            link = url.resolve(href)
+                        except Exception:
+                            continue
+                        if link.scheme not in ["http", "https", "file"]: continue
+                        if self.same_host and \
+                            (link.scheme, link.host, link.port) != origin: continue
+                        key = self.key(link)
+                        if key in seen: continue
+                        seen.add(key)
+                        frontier.append((link, depth + 1))
+        self.elapsed = time.monotonic() - start
+        return self
+
+    def visit(self, url):
+        body = url.request(None)
+        nodes = HTMLParser(body).parse()
+        links = [a.attributes["href"] for a in nodes.index.tags.get("a", ())
+                 if "href" in a.attributes]
+        return url.received, links
+
+    def summary(self):
+        elapsed = max(self.elapsed, 1e-9)
+        return "{} pages ({} errors), {} bytes in {:.2f}s: " \
+            "{:.1f} pages/s, {:.0f} bytes/s".format(
+                self.pages, self.errors, self.bytes, self.elapsed,
+                self.pages / elapsed, self.bytes / elapsed)
+
+def crawl_main(args):
+    import argparse
+    parser = argparse.ArgumentParser(prog="browser.py crawl")
+    parser.add_argument("url")
+    parser.add_argument("--depth", type=int, default=3)
+    parser.add_argument("--pages", type=int, default=100)
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--any-host", action="store_true")
+    options = parser.parse_args(args)
+    crawler = Crawler(options.workers, options.depth, options.pages,
+                      not options.any_host)
+    def report(url, size, error):
+        if error is None:
+            print(size, url)
+        else:
+            print("error", url, repr(error))
+    crawler.crawl(URL(options.url), report)
+    print(crawler.summary())
 
 # Entry point
 if __name__ == "__main__":
     import sys
-    Browser().new_tab(URL(sys.argv[1]))
+    if sys.argv[1] == "text":
+        # python browser.py text URL...: print each page's text and exit.
+        for arg in sys.argv[2:]:
+            load(URL(arg))
+        sys.exit(0)
+    if sys.argv[1] == "crawl":
+        # python browser.py crawl URL [--depth N] [--pages N] [--workers N]
+        crawl_main(sys.argv[2:])
+        sys.exit(0)
+    # python browser.py [--speculate] URL: --speculate prefetches the pages
+    # the user is likely to open next (see Speculator).
+    speculate = "--speculate" in sys.argv
+    if speculate: sys.argv.remove("--speculate")
+    Browser(speculate).new_tab(URL(sys.argv[1]))
     tkinter.mainloop()
     body = URL(sys.argv[1]).request()
     nodes = HTMLParser(body).parse()